@@ -1,20 +1,25 @@
-import operator
+import itertools
 import os
 import time
-from typing import List
+from typing import TYPE_CHECKING, List
 
 import click
 
-import lib
-from base import Index, Blob, IndexEntry, Status, Tree, Commit, Mixin
-from lib import write_file, find_path, get_remote_master_hash, build_lines_data, http_request, extract_lines
+import tracing
+
+if TYPE_CHECKING:
+    from base import Ignore
+
+# base、lib、fsmonitor 等模块在各命令中按需导入，init 等不涉及对象读写的命令不加载 base
 
 
 # git init
+@tracing.traced("init")
 def init() -> None:
     """
     初始化工作目录
     """
+    from lib import write_file
     git_path = os.path.join(os.getcwd(), ".git")
     if os.path.exists(git_path):
         click.echo("工作目录已存在")
@@ -27,42 +32,125 @@ def init() -> None:
 
 
 # git add
-def add(paths: List[str]) -> None:
+def expand_paths(pathspecs: List[str], work_path: str, ignore: "Ignore", force: bool = False) -> [List[str], None]:
+    """
+    将文件、目录和 glob 展开为相对工作目录、以 / 分隔的文件路径，索引中的 path 统一为这种格式
+    目录和 glob 中被忽略的文件直接跳过，直接指定的文件或目录被忽略时需要 force
+    有 pathspec 没有匹配的文件时返回 None
+    """
+    import glob
+    paths = {}
+    for spec in pathspecs:
+        explicit = not glob.has_magic(spec)
+        matches = [spec] if explicit else sorted(glob.glob(spec, recursive=True))
+        if matches and explicit:
+            tracing.count("fs.stat")
+        if not matches or (explicit and not os.path.exists(spec)):
+            click.echo(f"{spec} 没有匹配的文件")
+            return None
+        for match in matches:
+            # work_path 是 realpath，只解析上级目录中的符号链接，match 本身是符号链接时保持不变
+            parent, name = os.path.split(os.path.abspath(match))
+            path = os.path.relpath(os.path.join(os.path.realpath(parent), name), work_path).replace(os.sep, '/')
+            assert not path.startswith('../'), f"{match} 不在工作目录 {work_path} 中"
+            path = '' if path == '.' else path
+            if path == ".git" or path.startswith(".git/"):
+                continue
+            is_dir = os.path.isdir(match)
+            tracing.count("fs.stat")
+            if path and not (explicit and force) and ignore.is_path_ignored(path, is_dir):
+                if explicit:
+                    click.echo(f"{path} 已被忽略，使用 -f 强制添加")
+                continue
+            if is_dir:
+                paths.update(dict.fromkeys(ignore.walk(path)))
+            else:
+                paths[path] = None
+    return list(paths)
+
+
+@tracing.traced("add")
+def add(paths: List[str], workers: int = 0, force: bool = False) -> None:
     """
-    添加 paths 的内容到 git 管理
+    添加 paths 的内容到 git 管理，paths 可以是文件、目录或 glob
     就是将这些路径中的文件添加到 ./git/objects ，
     然后再使用这些文件生成的 sha1 生成 .git/index 索引
+    文件个数达到 BULK_CHECKIN_FILES 时新的 blob 写入一个 pack，索引在最后一次写入
     """
+    import lib
+    from base import Index, Blob, IndexEntry, HashEngine, Ignore, BulkCheckin
+    from lib import find_path
     git_path = find_path()
+    work_path = os.path.dirname(git_path)
+    with tracing.Span("add.expand"):
+        paths = expand_paths(paths, work_path, Ignore(work_path, git_path), force)
+    if not paths:
+        return
+    full_paths = [os.path.join(work_path, path) for path in paths]
 
     index = Index(git_path)
-    blob = Blob(git_path)
+    with tracing.Span("add.read_index"):
+        table = index.table()
+    # 在读取文件内容之前记录 stat，计算 sha1 期间文件被修改时，索引中的 stat 不会对应到未计算过的新内容
+    stats = [os.stat(full_path) for full_path in full_paths]
+    tracing.count("fs.stat", len(full_paths))
+    # 读取现有索引，有变动的文件重新生成加密的对象，在索引中插入或更新
+    with tracing.Span("add.write_objects"):
+        if lib.BULK_CHECKIN_FILES and len(paths) >= lib.BULK_CHECKIN_FILES:
+            sha1s = BulkCheckin(git_path, workers).checkin(full_paths)
+        else:
+            sha1s = HashEngine(Blob(git_path), workers).compress(full_paths)
+    entries = []
+    for path, full_path, sha1, st in zip(paths, full_paths, sha1s, stats):
+        flags = len(path.encode())
+        assert flags < (1 << 12)
+        ctime_s, ctime_n = divmod(st.st_ctime_ns, 1000000000)
+        mtime_s, mtime_n = divmod(st.st_mtime_ns, 1000000000)
+        size = st.st_size
+        # 计算 sha1 期间文件有变动时 sha1 可能对应新旧任一内容，清零 size 和 mtime，status 总会重新计算 sha1
+        new_st = os.stat(full_path)
+        tracing.count("fs.stat")
+        if (new_st.st_mtime_ns, new_st.st_ctime_ns, new_st.st_size, new_st.st_ino) != \
+                (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino):
+            size, mtime_s, mtime_n = 0, 0, 0
+        entries.append(IndexEntry(
+            ctime_s, ctime_n, mtime_s, mtime_n, st.st_dev,
+            st.st_ino, st.st_mode, st.st_uid, st.st_gid, size,
+            bytes.fromhex(sha1), flags, path))
+    table.update(entries)
+    with tracing.Span("add.write_index"):
+        index.write_index(table)
 
-    # 若索引存在，则将没有数据变动的索引记录下来，放到 entries 中
-    all_entries = index.read_index()
-    entries = [e for e in all_entries if e.path not in paths]
 
-    # 将有变动的文件重新生成加密的对象，放入索引中
-    for path in paths:
-        sha1 = blob.compress(path)
-        st, flags = os.stat(path), len(path.encode())
-        assert flags < (1 << 12)
-        entry = IndexEntry(
-            int(st.st_ctime), 0, int(st.st_mtime), 0, st.st_dev,
-            st.st_ino, st.st_mode, st.st_uid, st.st_gid, st.st_size,
-            bytes.fromhex(sha1), flags, path)
-        entries.append(entry)
-    # 根据 path 排序
-    entries.sort(key=operator.attrgetter('path'))
-    index.write_index(entries)
+# git fsmonitor--daemon
+@tracing.traced("fsmonitor")
+def fsmonitor(action: str) -> None:
+    """
+    启动或停止文件监控进程，status/diff 在监控进程运行时只检查有变动的文件
+    """
+    import fsmonitor as fsmonitor_daemon
+    from lib import find_path
+    git_path = find_path()
+    if action == "start":
+        work_path = os.path.realpath(os.path.join(git_path, ".."))
+        if fsmonitor_daemon.start(work_path, git_path):
+            click.echo("文件监控已启动")
+        else:
+            click.echo("文件监控启动失败")
+    elif fsmonitor_daemon.stop(git_path):
+        click.echo("文件监控已停止")
+    else:
+        click.echo("文件监控没有运行")
 
 
 # git status
-def status():
+@tracing.traced("status")
+def status(workers: int = 0):
     """
     获取当前工作目录状态
     """
-    changed, new, deleted = Status().get_status()
+    from base import Status
+    changed, new, deleted = Status(workers=workers).get_status()
     if changed:
         click.echo("文件改变:")
         for path in changed:
@@ -78,16 +166,22 @@ def status():
 
 
 # git diff
-def diff():
-    Status().diff()
+@tracing.traced("diff")
+def diff(workers: int = 0, context: int = 3):
+    from base import Status
+    Status(workers=workers).diff(context)
 
 
 # git commit
+@tracing.traced("commit")
 def commit(message, author):
+    from base import Tree, Commit
+    from lib import write_file, find_path
     path = find_path()
     tree_obj = Tree(path)
     commit_obj = Commit(path)
-    tree = tree_obj.write_tree()
+    with tracing.Span("commit.write_tree"):
+        tree = tree_obj.write_tree()
     parent = commit_obj.get_local_master_hash()
     auth_time = time.strftime("%Y-%m-%d %H:%M:%S")
     lines = ['tree ' + tree]
@@ -102,33 +196,131 @@ def commit(message, author):
     sha1 = commit_obj.compress(data)
     master_path = os.path.join(commit_obj.get_master_path())
     write_file(master_path, (sha1 + '\n').encode())
+    # 只追加新的 commit，父结点不在 commit-graph 中时留给 gc 或 commit-graph 命令
+    commit_obj.append_commit_graph(sha1)
     print('committed to master: {:7}'.format(sha1))
     return sha1
 
 
+# git log
+@tracing.traced("log")
+def log(max_count: int = 0, oneline: bool = False):
+    """
+    按提交时间从新到旧显示 master 的提交历史
+    遍历通过 commit-graph 完成，只解压需要显示的 commit
+    """
+    from base import Commit
+    from lib import find_path
+    commit_obj = Commit(find_path())
+    local_sha1 = commit_obj.get_local_master_hash()
+    if not local_sha1:
+        click.echo("没有提交")
+        return
+    history = commit_obj.iter_history(local_sha1)
+    for sha1 in itertools.islice(history, max_count or None):
+        header, _, message = commit_obj.decompress(sha1).decode().partition('\n\n')
+        if oneline:
+            print('{} {}'.format(sha1[:7], message.strip().split('\n')[0]))
+            continue
+        print('commit ' + sha1)
+        for line in header.splitlines():
+            if line.startswith('author '):
+                print('Author: ' + line[7:])
+        print()
+        for line in message.strip().splitlines():
+            print('    ' + line)
+        print()
+
+
+# git commit-graph write
+@tracing.traced("commit-graph")
+def commit_graph():
+    """
+    重新生成 commit-graph，合并为只有一层的 split commit-graph
+    """
+    from base import Commit
+    from lib import find_path
+    commit_obj = Commit(find_path())
+    local_sha1 = commit_obj.get_local_master_hash()
+    if not local_sha1:
+        click.echo("没有提交")
+        return
+    count = commit_obj.write_commit_graph([local_sha1])
+    click.echo(f"写入 {count} 个提交到 commit-graph")
+
+
+# git gc
+@tracing.traced("gc")
+def gc(window: int = 10, depth: int = 50):
+    """
+    将 master 可达的对象打包为一个使用 delta 压缩的 pack，再删除已打包的松散对象和旧 pack，
+    最后生成 commit-graph 和 pack 的 bitmap
+    """
+    from base import Tree, Commit, Mixin
+    from lib import find_path
+    git_path = find_path()
+    commit_obj = Commit(git_path)
+    local_sha1 = commit_obj.get_local_master_hash()
+    if not local_sha1:
+        click.echo("没有需要打包的提交")
+        return
+    with tracing.Span("gc.find_objects"):
+        names = commit_obj.find_named_objects(local_sha1, Tree(git_path))
+    mixin_obj = Mixin(git_path)
+    with tracing.Span("gc.write_pack"):
+        pack_sha1 = mixin_obj.write_pack(names, window, depth)
+    with tracing.Span("gc.prune"):
+        pruned = mixin_obj.prune_packed(pack_sha1)
+    # commit_obj 加载的 pack 列表中没有新的 pack，松散对象删除后需要重新加载才能读取 commit
+    commit_obj = Commit(git_path)
+    with tracing.Span("gc.commit_graph"):
+        commit_obj.write_commit_graph([local_sha1])
+    with tracing.Span("gc.bitmap"):
+        bitmaps = commit_obj.write_pack_bitmap(pack_sha1, local_sha1, names)
+    click.echo(f"打包 {len(names)} 个对象到 pack-{pack_sha1}.pack，删除 {pruned} 个松散对象，写入 {bitmaps} 个 bitmap")
+
+
+@tracing.traced("push")
 def push(git_url=None, username=None, password=None):
+    import lib
+    from base import Tree, Commit, Mixin
+    from lib import get_remote_info, build_lines_data, get_transport, PktLineReader, SidebandReader
     commit_obj = Commit()
     username = lib.USERNAME
     password = lib.PASSWORD
     git_url = lib.G_GITHUB_REPO
     mixin_obj = Mixin()
-    remote_sha1 = get_remote_master_hash(git_url, username, password)
+    with tracing.Span("push.remote_info"):
+        remote_sha1, capabilities = get_remote_info(git_url, username, password)
     local_sha1 = commit_obj.get_local_master_hash()
-    missing = commit_obj.find_missing_objects(local_sha1, remote_sha1)
+    # 远程 master 不在本地或不是本地 master 的祖先时，push 会覆盖远程的提交，直接拒绝
+    if remote_sha1 and not commit_obj.has_object(remote_sha1):
+        raise click.ClickException(f"远程 master {remote_sha1[:7]} 有本地没有的提交，需要先获取远程的提交")
+    if remote_sha1 and not commit_obj.is_ancestor(remote_sha1, local_sha1):
+        raise click.ClickException(f"远程 master {remote_sha1[:7]} 不是本地 master 的祖先 (non-fast-forward)")
+    with tracing.Span("push.find_objects"):
+        missing = commit_obj.find_missing_objects(local_sha1, remote_sha1)
+        # 远程 master 的 tree 中的对象可以作为 thin pack 的 delta base
+        bases = commit_obj.find_edge_objects(remote_sha1, Tree(commit_obj.git_path)) if remote_sha1 else None
     print(
         f"{remote_sha1 or '没有提交'} 到 {local_sha1} {len(missing)} 个对象{'' if len(missing) == 1 else 's'}")
-    lines = ['{} {} refs/heads/master\x00 report-status'.format(
-        remote_sha1 or ('0' * 40), local_sha1).encode()]
-    data = build_lines_data(lines) + mixin_obj.create_pack(missing)
+    # 服务端支持时使用 side-band-64k，report-status 在通道 1 中返回，通道 2 的进度信息输出到标准错误
+    sideband = b'side-band-64k' in capabilities
+    lines = ['{} {} refs/heads/master\x00 report-status{}'.format(
+        remote_sha1 or ('0' * 40), local_sha1, ' side-band-64k' if sideband else '').encode()]
+    # 命令行和 pack 数据以生成器的形式分块上传，不在内存中拼接完整的请求
+    data = itertools.chain([build_lines_data(lines)], mixin_obj.iter_pack(missing, bases, b'ofs-delta' in capabilities))
     url = git_url + '/git-receive-pack'
-    response = http_request(url, username, password, data=data)
-    lines = extract_lines(response)
-    assert len(lines) >= 2, \
-        'expected at least 2 lines, got {}'.format(len(lines))
-    assert lines[0] == b'unpack ok\n', \
-        "expected line 1 b'unpack ok', got: {}".format(lines[0])
-    assert lines[1] == b'ok refs/heads/master\n', \
-        "expected line 2 b'ok refs/heads/master\n', got: {}".format(lines[1])
+    with tracing.Span("push.upload"), get_transport(username, password).open(
+            url, data, {"Content-Type": "application/x-git-receive-pack-request"}) as response:
+        reader = PktLineReader(response)
+        if sideband:
+            reader = PktLineReader(SidebandReader(reader))
+        # report-status 逐行接收和检查，不需要读取完整的响应
+        unpack = bytes(reader.read_pkt() or b'')
+        assert unpack == b'unpack ok\n', \
+            "expected line 1 b'unpack ok', got: {}".format(unpack)
+        statuses = [bytes(line) for line in reader]
+    assert b'ok refs/heads/master\n' in statuses, \
+        "expected b'ok refs/heads/master\n', got: {}".format(statuses)
     return (remote_sha1, missing)
-
-push()
\ No newline at end of file
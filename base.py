@@ -1,15 +1,34 @@
+import bisect
 import collections
-import difflib
 import hashlib
+import heapq
+import itertools
+import mmap
 import os
 import re
 import stat
 import struct
+import sys
+import threading
+import time
 import zlib
+from array import array
 from functools import singledispatchmethod
-from typing import List, Tuple
+from typing import Iterator, List, Set, Tuple
 
-from lib import write_file, find_path, read_file
+import fsmonitor
+import tracing
+import xdiff
+
+from lib import write_file, lock_file, temp_file, find_path, read_file, HASH_WORKERS, CHUNK_SIZE, \
+    OBJECT_CACHE_BYTES, SPLIT_INDEX_ENTRIES, SPLIT_INDEX_PERCENT, BULK_CHECKIN_MAX_SIZE, BIG_FILE_THRESHOLD, \
+    DELTA_WINDOW_MEMORY
+
+# 计算 delta 时 base 的分块大小
+DELTA_BLOCK = 16
+# 建立索引前从 target 中均匀抽取的块数，一块都不在 base 中时直接放弃
+DELTA_SAMPLES = 16
+EWAH_MASK = (1 << 64) - 1
 
 # .git/index 中索引的内容
 IndexEntry = collections.namedtuple('IndexEntry', [
@@ -18,6 +37,972 @@ IndexEntry = collections.namedtuple('IndexEntry', [
 ])
 
 
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """
+    将 pack 中的 delta 数据应用到 base 对象上，得到目标对象的内容
+    delta 由 [base 长度, 目标长度] 两个变长整数和一系列指令组成，
+    最高位为 1 的指令从 base 中复制一段数据，否则直接插入指令后面的 n 个字节
+    """
+    base_size, i = _read_delta_size(delta, 0)
+    target_size, i = _read_delta_size(delta, i)
+    assert base_size == len(base), f"delta base 长度应为 {base_size}, 得到 {len(base)}"
+    result = bytearray()
+    while i < len(delta):
+        op = delta[i]
+        i += 1
+        if op & 0x80:
+            offset = size = 0
+            for bit in range(4):
+                if op & (1 << bit):
+                    offset |= delta[i] << (8 * bit)
+                    i += 1
+            for bit in range(3):
+                if op & (0x10 << bit):
+                    size |= delta[i] << (8 * bit)
+                    i += 1
+            result += base[offset:offset + (size or 0x10000)]
+        elif op:
+            result += delta[i:i + op]
+            i += op
+        else:
+            raise ValueError("delta 指令非法")
+    assert len(result) == target_size, f"delta 结果长度应为 {target_size}, 得到 {len(result)}"
+    return bytes(result)
+
+
+def _read_delta_size(delta: bytes, i: int) -> Tuple[int, int]:
+    """
+    读取 delta 头部小端序的变长整数，返回 (数值, 下一个位置)
+    """
+    size = shift = 0
+    while True:
+        byte = delta[i]
+        i += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, i
+
+
+def create_delta(base: bytes, target: bytes, max_size: int = 0) -> [bytes, None]:
+    """
+    计算把 base 变为 target 的 delta，格式与 apply_delta 一致
+    base 按 DELTA_BLOCK 字节分块建立索引，扫描 target 查找相同的块并向前后扩展为复制指令，
+    其余部分作为插入指令；max_size 不为 0 时，delta 超过该长度立即放弃并返回 None
+    max_size 不为 0 时先做廉价的检查：target 比 base 多出的部分至少要作为插入指令输出，超过 max_size 时放弃；
+    抽取的 DELTA_SAMPLES 个块都不在 base 中时也放弃，不再建立索引
+    """
+    if max_size:
+        if len(target) - len(base) >= max_size:
+            return None
+        step = max(DELTA_BLOCK, len(target) // DELTA_SAMPLES)
+        if len(target) >= DELTA_BLOCK and not any(
+                target[i:i + DELTA_BLOCK] in base for i in range(0, len(target) - DELTA_BLOCK + 1, step)):
+            return None
+    index = {}
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[i:i + DELTA_BLOCK], i)
+    result = bytearray(_encode_delta_size(len(base)) + _encode_delta_size(len(target)))
+    insert_start = i = 0
+    target_size = len(target)
+    while i + DELTA_BLOCK <= target_size:
+        if max_size and len(result) + i - insert_start > max_size:
+            return None
+        offset = index.get(target[i:i + DELTA_BLOCK])
+        if offset is None:
+            i += 1
+            continue
+        # 向前扩展到尚未输出的插入数据中
+        while i > insert_start and offset > 0 and target[i - 1] == base[offset - 1]:
+            i -= 1
+            offset -= 1
+        # 向后扩展，先按大块比较再逐字节比较
+        length = DELTA_BLOCK
+        step = 256
+        while i + length < target_size and offset + length < len(base):
+            if target[i + length:i + length + step] == base[offset + length:offset + length + step]:
+                length += min(step, target_size - i - length, len(base) - offset - length)
+            elif step > 1:
+                step //= 16
+            else:
+                break
+        _append_insert(result, target[insert_start:i])
+        for start in range(0, length, 0x10000):
+            result += _encode_copy(offset + start, min(0x10000, length - start))
+        i += length
+        insert_start = i
+    _append_insert(result, target[insert_start:])
+    if max_size and len(result) > max_size:
+        return None
+    return bytes(result)
+
+
+def _encode_delta_size(size: int) -> bytes:
+    """
+    将长度编码为 delta 头部小端序的变长整数
+    """
+    result = bytearray()
+    while True:
+        byte = size & 0x7f
+        size >>= 7
+        if not size:
+            result.append(byte)
+            return bytes(result)
+        result.append(byte | 0x80)
+
+
+def _encode_copy(offset: int, size: int) -> bytes:
+    """
+    编码复制指令，offset 和 size 中为 0 的字节省略，size 为 0x10000 时全部省略
+    """
+    op = 0x80
+    args = bytearray()
+    for bit in range(4):
+        byte = (offset >> (8 * bit)) & 0xff
+        if byte:
+            op |= 1 << bit
+            args.append(byte)
+    for bit in range(3):
+        byte = (size >> (8 * bit)) & 0xff
+        if byte:
+            op |= 0x10 << bit
+            args.append(byte)
+    return bytes([op]) + bytes(args)
+
+
+def _append_insert(result: bytearray, data: bytes) -> None:
+    """
+    追加插入指令，每条指令最多插入 127 个字节
+    """
+    for start in range(0, len(data), 0x7f):
+        chunk = data[start:start + 0x7f]
+        result.append(len(chunk))
+        result += chunk
+
+
+class PackIndex:
+    """
+    读取 .git/objects/pack/*.idx (version 2) 文件，idx 文件通过 mmap 映射到内存
+    文件结构：8 字节头部 [\\377tOc, version]，256 个 4 字节的 fan-out 表，
+    之后依次为排好序的 sha1 表、crc32 表、4 字节 offset 表、8 字节大 offset 表，最后是 pack 和 idx 的 sha1
+    fan-out 表第 i 项记录首字节 <= i 的对象个数，查找时先用首字节缩小范围再二分查找
+    """
+
+    SIGNATURE = b'\xfftOc'
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version = struct.unpack('!4sL', self.data[:8])
+        assert signature == self.SIGNATURE, f"idx 签名不合法 {signature}"
+        assert version == 2, f"idx 版本不合法 {version}"
+        self.fanout = struct.unpack('!256L', self.data[8:8 + 256 * 4])
+        self.count = self.fanout[255]
+        self.sha1_offset = 8 + 256 * 4
+        self.crc_offset = self.sha1_offset + 20 * self.count
+        self.offset_offset = self.crc_offset + 4 * self.count
+        self.large_offset = self.offset_offset + 4 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def sha1_at(self, i: int) -> bytes:
+        start = self.sha1_offset + 20 * i
+        return self.data[start:start + 20]
+
+    def offset_at(self, i: int) -> int:
+        start = self.offset_offset + 4 * i
+        offset, = struct.unpack('!L', self.data[start:start + 4])
+        if offset & 0x80000000:
+            start = self.large_offset + 8 * (offset & 0x7fffffff)
+            offset, = struct.unpack('!Q', self.data[start:start + 8])
+        return offset
+
+    def _bisect(self, key: bytes) -> int:
+        """
+        在 fan-out 表确定的范围内二分查找，返回第一个 >= key 的位置
+        """
+        lo = self.fanout[key[0] - 1] if key[0] else 0
+        hi = self.fanout[key[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha1_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def position(self, sha1: bytes) -> [int, None]:
+        """
+        根据 20 字节的 sha1 查找对象在 idx 中的位置，没有就返回 None
+        """
+        i = self._bisect(sha1)
+        if i < self.count and self.sha1_at(i) == sha1:
+            return i
+        return None
+
+    def find(self, sha1: bytes) -> [int, None]:
+        """
+        根据 20 字节的 sha1 查找对象在 pack 中的偏移量，没有就返回 None
+        """
+        i = self.position(sha1)
+        return None if i is None else self.offset_at(i)
+
+    def offsets(self) -> List[int]:
+        """
+        按 idx 顺序返回全部对象在 pack 中的偏移量
+        """
+        offsets = list(struct.unpack_from(f'!{self.count}L', self.data, self.offset_offset))
+        return [self.offset_at(i) if offset & 0x80000000 else offset for i, offset in enumerate(offsets)]
+
+    def find_prefix(self, prefix: str) -> List[str]:
+        """
+        根据 16 进制的 sha1 前缀查找所有匹配的对象
+        奇数长度的前缀补 0，从该前缀最小的 sha1 开始查找
+        """
+        key = bytes.fromhex((prefix + '0' * (len(prefix) % 2)).ljust(2, '0'))
+        matches = []
+        for i in range(self._bisect(key), self.count):
+            sha1 = self.sha1_at(i).hex()
+            if not sha1.startswith(prefix):
+                break
+            matches.append(sha1)
+        return matches
+
+    def sha1s(self):
+        for i in range(self.count):
+            yield self.sha1_at(i).hex()
+
+
+class Pack:
+    """
+    读取 .git/objects/pack/*.pack 文件，对象在 pack 中的位置由同名 .idx 文件给出
+    pack 中的对象为 [类型+长度的变长头部, zlib 压缩数据]，
+    类型为 OFS_DELTA/REF_DELTA 的对象需要先取得 base 对象，再应用 delta
+    """
+
+    TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+    OFS_DELTA = 6
+    REF_DELTA = 7
+
+    def __init__(self, idx_path: str):
+        self.index = PackIndex(idx_path)
+        self.path = idx_path[:-len(".idx")] + ".pack"
+        with open(self.path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, _ = struct.unpack('!4sLL', self.data[:12])
+        assert signature == b'PACK', f"pack 签名不合法 {signature}"
+        assert version == 2, f"pack 版本不合法 {version}"
+        self._bitmap = False
+
+    @property
+    def bitmap(self) -> ["PackBitmap", None]:
+        """
+        与 pack 同名的 .bitmap 文件，不存在时为 None
+        """
+        if self._bitmap is False:
+            self._bitmap = PackBitmap.load(self)
+        return self._bitmap
+
+    def find(self, sha1: str) -> [int, None]:
+        return self.index.find(bytes.fromhex(sha1))
+
+    def read(self, offset: int, resolve=None) -> Tuple[str, bytes]:
+        """
+        读取 offset 处的对象，返回 (对象类型, 对象内容)
+        REF_DELTA 的 base 不在本 pack 中时调用 resolve(sha1) 获取
+        """
+        deltas = []
+        while True:
+            type_num, size, pos = self._read_header(offset)
+            if type_num == self.OFS_DELTA:
+                distance, pos = self._read_ofs(pos)
+                deltas.append(self._inflate(pos, size))
+                offset -= distance
+            elif type_num == self.REF_DELTA:
+                base_sha1 = self.data[pos:pos + 20].hex()
+                deltas.append(self._inflate(pos + 20, size))
+                base_offset = self.find(base_sha1)
+                if base_offset is None:
+                    assert resolve, f"未找到 delta base {base_sha1}"
+                    obj_type, data = resolve(base_sha1)
+                    break
+                offset = base_offset
+            else:
+                obj_type, data = self.TYPES[type_num], self._inflate(pos, size)
+                break
+        for delta in reversed(deltas):
+            data = apply_delta(data, delta)
+        return obj_type, data
+
+    def read_info(self, offset: int, resolve=None) -> Tuple[str, int]:
+        """
+        只解析头部获取 offset 处对象的 (对象类型, 对象长度)，不解压完整数据
+        delta 对象的长度记录在 delta 数据头部，类型与 delta 链末端的 base 相同
+        """
+        type_num, size, pos = self._read_header(offset)
+        first = True
+        while type_num in (self.OFS_DELTA, self.REF_DELTA):
+            base_sha1 = None
+            if type_num == self.OFS_DELTA:
+                distance, pos = self._read_ofs(pos)
+                offset -= distance
+            else:
+                base_sha1 = self.data[pos:pos + 20].hex()
+                pos += 20
+            if first:
+                header = zlib.decompressobj().decompress(self.data[pos:pos + 64], 20)
+                size = _read_delta_size(header, _read_delta_size(header, 0)[1])[0]
+                first = False
+            if base_sha1:
+                base_offset = self.find(base_sha1)
+                if base_offset is None:
+                    assert resolve, f"未找到 delta base {base_sha1}"
+                    return resolve(base_sha1)[0], size
+                offset = base_offset
+            type_num, _, pos = self._read_header(offset)
+        return self.TYPES[type_num], size
+
+    def _read_ofs(self, pos: int) -> Tuple[int, int]:
+        """
+        解析 OFS_DELTA 中 base 对象的相对距离，返回 (距离, 下一个位置)
+        """
+        byte = self.data[pos]
+        pos += 1
+        distance = byte & 0x7f
+        while byte & 0x80:
+            byte = self.data[pos]
+            pos += 1
+            distance = ((distance + 1) << 7) | (byte & 0x7f)
+        return distance, pos
+
+    def _read_header(self, offset: int) -> Tuple[int, int, int]:
+        """
+        解析对象头部，返回 (类型编号, 解压后的长度, 数据起始位置)
+        """
+        byte = self.data[offset]
+        offset += 1
+        type_num = (byte >> 4) & 0x07
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = self.data[offset]
+            offset += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        return type_num, size, offset
+
+    def _inflate(self, pos: int, size: int) -> bytes:
+        """
+        从 pos 处分块解压 zlib 数据，避免复制 pack 剩余的全部内容
+        """
+        view = memoryview(self.data)
+        decompressor = zlib.decompressobj()
+        chunks = []
+        while not decompressor.eof:
+            chunk = view[pos:pos + CHUNK_SIZE]
+            if not chunk:
+                raise ValueError(f"pack 数据不完整 {self.path}")
+            chunks.append(decompressor.decompress(chunk))
+            pos += len(chunk)
+        data = b''.join(chunks)
+        assert len(data) == size, f"数据长度应为 {size}, 得到 {len(data)} bytes"
+        tracing.count("objects.inflated")
+        tracing.count("zlib.bytes_inflated", size)
+        return data
+
+
+def pack_name_hash(name: str) -> int:
+    """
+    git 打包时使用的路径名 hash，主要由路径最后的 16 个字符决定，同名文件的 hash 相近
+    """
+    value = 0
+    for byte in name.encode():
+        if byte in b' \t\n\v\f\r':
+            continue
+        value = ((value >> 2) + (byte << 24)) & 0xffffffff
+    return value
+
+
+def ewah_encode(bits: int) -> bytes:
+    """
+    将位图 (第 i 位表示第 i 个对象) 编码为 git 使用的 EWAH 压缩格式
+    格式为 [位数, 字数, 64 位的字..., 最后一个 RLW 的位置]，
+    RLW 字的第 0 位为连续字的值，1-32 位为连续全 0 或全 1 字的个数，33-63 位为其后未压缩字的个数
+    """
+    bit_size = bits.bit_length()
+    count = (bit_size + 63) // 64
+    words = struct.unpack(f'<{count}Q', bits.to_bytes(count * 8, 'little'))
+    result = []
+    rlw = i = 0
+    while i < count:
+        run_word = words[i] if words[i] in (0, EWAH_MASK) else 0
+        run = 0
+        while i < count and words[i] == run_word and run < 0xffffffff:
+            run += 1
+            i += 1
+        literal_start = i
+        while i < count and words[i] not in (0, EWAH_MASK) and i - literal_start < 0x7fffffff:
+            i += 1
+        rlw = len(result)
+        result.append((run_word & 1) | (run << 1) | ((i - literal_start) << 33))
+        result.extend(words[literal_start:i])
+    if not result:
+        # 和 git 一样，空位图也保留一个 RLW 字
+        result.append(0)
+    return (struct.pack('!LL', bit_size, len(result)) + struct.pack(f'!{len(result)}Q', *result) +
+            struct.pack('!L', rlw))
+
+
+def ewah_decode(data, pos: int) -> Tuple[int, int]:
+    """
+    从 pos 处解析 EWAH 位图，返回 (位图, 下一个位置)
+    """
+    _, count = struct.unpack_from('!LL', data, pos)
+    words = struct.unpack_from(f'!{count}Q', data, pos + 8)
+    result = []
+    i = 0
+    while i < count:
+        rlw = words[i]
+        literals = rlw >> 33
+        result.extend([EWAH_MASK if rlw & 1 else 0] * ((rlw >> 1) & 0xffffffff))
+        result.extend(words[i + 1:i + 1 + literals])
+        i += 1 + literals
+    bits = int.from_bytes(struct.pack(f'<{len(result)}Q', *result), 'little')
+    return bits, pos + 8 + 8 * count + 4
+
+
+def iter_bits(bits: int):
+    """
+    按从低到高的顺序生成位图中为 1 的位置
+    """
+    for i, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, 'little')):
+        while byte:
+            low = byte & -byte
+            yield i * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+class PackBitmap:
+    """
+    读写与 pack 同名的 .bitmap 文件 (git 的 bitmap version 1 格式)
+    位图的第 i 位表示 pack 中第 i 个 (按偏移量排序) 对象，每个选中的 commit 保存其可达全部对象的位图
+    文件结构：[BITM, version, options, 位图个数, pack sha1]，commit/tree/blob/tag 四个类型位图，
+    然后是每个 commit 的 [idx 位置, xor 偏移, flags, EWAH 位图]，最后是按 idx 顺序的路径名 hash
+    reachable:
+        计算 commit 可达的对象，没有位图的 commit 向下遍历到有位图的 commit 为止
+    find_missing:
+        local 可达对象的位图 AND-NOT remote 可达对象的位图，得到需要 push 的对象
+    """
+
+    SIGNATURE = b'BITM'
+    OPT_FULL_DAG = 1
+    OPT_HASH_CACHE = 4
+    TYPES = ("commit", "tree", "blob", "tag")
+
+    def __init__(self, pack: Pack):
+        self.pack = pack
+        self.path = pack.path[:-len(".pack")] + ".bitmap"
+        self.bitmaps = {}
+        self.hashes = None
+        offsets = pack.index.offsets()
+        # pack 顺序与 idx 顺序的相互转换
+        self.order = sorted(range(len(offsets)), key=offsets.__getitem__)
+        self.positions = [0] * len(offsets)
+        for pos, i in enumerate(self.order):
+            self.positions[i] = pos
+
+    @classmethod
+    def load(cls, pack: Pack) -> ["PackBitmap", None]:
+        bitmap = cls(pack)
+        try:
+            data = read_file(bitmap.path)
+        except FileNotFoundError:
+            return None
+        signature, version, options, count = struct.unpack_from('!4sHHL', data, 0)
+        assert signature == cls.SIGNATURE, f"bitmap 签名不合法 {signature}"
+        assert version == 1, f"bitmap 版本不合法 {version}"
+        assert data[12:32] == pack.data[-20:], f"bitmap 与 pack 不匹配 {bitmap.path}"
+        pos = 32
+        for _ in cls.TYPES:
+            pos = ewah_decode(data, pos)[1]
+        entries = []
+        for _ in range(count):
+            i, xor_offset, _ = struct.unpack_from('!LBB', data, pos)
+            bits, pos = ewah_decode(data, pos + 6)
+            if xor_offset:
+                bits ^= entries[-xor_offset]
+            entries.append(bits)
+            bitmap.bitmaps[pack.index.sha1_at(i).hex()] = bits
+        if options & cls.OPT_HASH_CACHE:
+            bitmap.hashes = struct.unpack_from(f'!{len(bitmap.order)}L', data, pos)
+        return bitmap
+
+    def position(self, sha1: str) -> [int, None]:
+        """
+        对象在位图中的位置，不在 pack 中时返回 None
+        """
+        i = self.pack.index.position(bytes.fromhex(sha1))
+        return None if i is None else self.positions[i]
+
+    def sha1_at(self, pos: int) -> str:
+        return self.pack.index.sha1_at(self.order[pos]).hex()
+
+    def reachable(self, commit_sha1: str, commit_obj, tree_obj) -> Tuple[int, dict]:
+        """
+        计算 commit 可达的对象，返回 (pack 中对象的位图, 不在 pack 中的 {sha1: 路径名})
+        遍历 commit 直到遇到有位图的 commit，只有经过的 commit 的 tree 需要展开，
+        展开时位图中已有的 tree 不再向下遍历
+        """
+        bits = 0
+        commits, stack, seen = [], [commit_sha1], set()
+        while stack:
+            sha1 = stack.pop()
+            if sha1 in seen:
+                continue
+            seen.add(sha1)
+            if sha1 in self.bitmaps:
+                bits |= self.bitmaps[sha1]
+                continue
+            commits.append(sha1)
+            stack.extend(commit_obj.read_commit(sha1)[1])
+        buf = bytearray(bits.to_bytes(len(self.order) // 8 + 1, 'little'))
+        extra = {}
+
+        def mark(sha1, name):
+            pos = self.position(sha1)
+            if pos is None:
+                if sha1 in extra:
+                    return False
+                extra[sha1] = name
+                return True
+            if buf[pos >> 3] >> (pos & 7) & 1:
+                return False
+            buf[pos >> 3] |= 1 << (pos & 7)
+            return True
+
+        for sha1 in commits:
+            mark(sha1, '')
+            trees = [(commit_obj.read_commit(sha1)[0], '')]
+            while trees:
+                tree_sha1, name = trees.pop()
+                if not mark(tree_sha1, name):
+                    continue
+                for mode, path, obj_sha1 in tree_obj.read_tree(tree_sha1):
+                    path = f"{name}/{path}" if name else path
+                    if stat.S_ISDIR(mode):
+                        trees.append((obj_sha1, path))
+                    else:
+                        mark(obj_sha1, path)
+        return int.from_bytes(buf, 'little'), extra
+
+    def find_missing(self, local_sha1: str, remote_sha1: [str, None], commit_obj, tree_obj) -> dict:
+        """
+        返回 local_sha1 可达而 remote_sha1 不可达的 {sha1: 路径名或路径名 hash}
+        """
+        local_bits, local_extra = self.reachable(local_sha1, commit_obj, tree_obj)
+        remote_bits, remote_extra = self.reachable(remote_sha1, commit_obj, tree_obj) if remote_sha1 else (0, {})
+        missing = {sha1: name for sha1, name in local_extra.items() if sha1 not in remote_extra}
+        for pos in iter_bits(local_bits & ~remote_bits):
+            missing[self.sha1_at(pos)] = self.hashes[self.order[pos]] if self.hashes else ''
+        return missing
+
+    def write(self, commits: List[str], names: dict, commit_obj, tree_obj) -> None:
+        """
+        为 commits 中的 commit 计算位图并写入 .bitmap 文件，commits 可达的对象必须都在 pack 中
+        names 为 {sha1: 路径名}，用于生成路径名 hash
+        """
+        count = len(self.order)
+        types = {obj_type: bytearray(count // 8 + 1) for obj_type in self.TYPES}
+        for pos, i in enumerate(self.order):
+            obj_type = self.pack.read_info(self.pack.index.offset_at(i))[0]
+            types[obj_type][pos >> 3] |= 1 << (pos & 7)
+        self.bitmaps = {}
+        for sha1 in reversed(commits):
+            bits, extra = self.reachable(sha1, commit_obj, tree_obj)
+            assert not extra, f"commit {sha1} 可达的对象不在 pack 中"
+            self.bitmaps[sha1] = bits
+        self.hashes = [pack_name_hash(names.get(self.pack.index.sha1_at(i).hex(), '')) for i in range(count)]
+        data = [struct.pack('!4sHHL', self.SIGNATURE, 1, self.OPT_FULL_DAG | self.OPT_HASH_CACHE, len(commits)),
+                self.pack.data[-20:]]
+        data.extend(ewah_encode(int.from_bytes(types[obj_type], 'little')) for obj_type in self.TYPES)
+        for sha1 in reversed(commits):
+            data.append(struct.pack('!LBB', self.pack.index.position(bytes.fromhex(sha1)), 0, 0))
+            data.append(ewah_encode(self.bitmaps[sha1]))
+        data.append(struct.pack(f'!{count}L', *self.hashes))
+        data = b''.join(data)
+        with lock_file(self.path) as f:
+            f.write(data + hashlib.sha1(data).digest())
+
+
+class ObjectCache:
+    """
+    按字节数限制大小的 LRU 缓存，缓存解压后的对象 {sha1: (对象类型, 对象内容)}
+    所有 HashObject 子类共用一个实例，遍历 commit/tree 和打包时不必重复解压同一个对象
+    命中和未命中的次数记录在 tracing 的 object_cache.hits/object_cache.misses 中
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, sha1: str) -> [Tuple[str, bytes], None]:
+        with self._lock:
+            item = self._items.get(sha1)
+            if item is None:
+                tracing.count("object_cache.misses")
+                return None
+            self._items.move_to_end(sha1)
+            tracing.count("object_cache.hits")
+            return item
+
+    def put(self, sha1: str, item: Tuple[str, bytes]) -> None:
+        """
+        加入缓存，超过上限时淘汰最久未使用的对象，单个对象大于上限时不缓存
+        """
+        size = len(item[1])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(sha1, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._items[sha1] = item
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, data) = self._items.popitem(last=False)
+                self.size -= len(data)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class CommitGraph:
+    """
+    读写 git 的 commit-graph version 1，可以是单个 .git/objects/info/commit-graph 文件，
+    也可以是 split commit-graph：objects/info/commit-graphs/commit-graph-chain 从下到上列出各层的 hash，
+    每层为同目录下的 graph-<hash>.graph 文件，和 git 一样单个文件存在时不读取 chain
+    文件由 8 字节头部 [CGPH, version, hash version, chunk 数, 下层个数]、chunk 目录和以下 chunk 组成：
+        OIDF: 256 个 4 字节的 fan-out 表
+        OIDL: 排好序的 commit sha1 表
+        CDAT: 每个 commit 定长 36 字节 [tree sha1, 第一个父结点位置, 第二个父结点位置, generation 和提交时间]
+        EDGE: 两个以上父结点时，第二个父结点位置指向这里的父结点列表
+        BASE: 所有下层的 hash，只在 split commit-graph 中出现
+    每个对象表示一层，base 为下一层，本层的 commit 位置排在所有下层之后，父结点位置都是包括下层在内的全局位置
+    generation 为 commit 到根结点的最长路径长度 + 1，父结点的 generation 总是小于子结点，
+    不在文件中的 commit 视为 generation 无穷大
+    """
+
+    SIGNATURE = b'CGPH'
+    PARENT_NONE = 0x70000000
+    PARENT_EXTRA = 0x80000000
+    GENERATION_MAX = 0x3fffffff
+    GENERATION_INFINITY = 0xffffffff
+    # 追加的新层 commit 个数乘以该值不小于下一层时合并两层，与 git 的 --size-multiple 默认值相同，层数保持在 O(log n)
+    SPLIT_SIZE_MULTIPLE = 2
+
+    def __init__(self, path: str = None, base: "CommitGraph" = None):
+        self.path = path
+        self.base = base
+        self.num_base = len(base) if base else 0
+        self.count = 0
+        self.hash = None
+        if path is None:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return
+        signature, version, hash_version, num_chunks, _ = struct.unpack_from('!4sBBBB', self.data, 0)
+        assert signature == self.SIGNATURE, f"commit-graph 签名不合法 {signature}"
+        assert version == 1 and hash_version == 1, f"commit-graph 版本不合法 {version}"
+        chunks = {}
+        for i in range(num_chunks):
+            chunk_id, offset = struct.unpack_from('!4sQ', self.data, 8 + 12 * i)
+            chunks[chunk_id] = offset
+        self.fanout = struct.unpack_from('!256L', self.data, chunks[b'OIDF'])
+        self.count = self.fanout[255]
+        self.oid_offset = chunks[b'OIDL']
+        self.cdat_offset = chunks[b'CDAT']
+        self.edge_offset = chunks.get(b'EDGE')
+        self.hash = self.data[-20:].hex()
+
+    @classmethod
+    def load(cls, git_path: str) -> "CommitGraph":
+        """
+        读取 commit-graph，单个文件优先，否则按 chain 从下到上逐层读取，都没有时返回空的 commit-graph
+        """
+        info_path = os.path.join(git_path, "objects", "info")
+        single_path = os.path.join(info_path, "commit-graph")
+        if os.path.exists(single_path):
+            return cls(single_path)
+        graph = None
+        for graph_hash in cls.read_chain(git_path):
+            graph = cls(os.path.join(info_path, "commit-graphs", f"graph-{graph_hash}.graph"), graph)
+        return graph or cls()
+
+    @staticmethod
+    def read_chain(git_path: str) -> List[str]:
+        path = os.path.join(git_path, "objects", "info", "commit-graphs", "commit-graph-chain")
+        try:
+            with open(path) as f:
+                return [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    @property
+    def is_split(self) -> bool:
+        return self.path is None or os.path.basename(self.path) != "commit-graph"
+
+    def layers(self) -> List["CommitGraph"]:
+        """
+        从下到上返回所有非空的层
+        """
+        layers, layer = [], self
+        while layer is not None:
+            if layer.count:
+                layers.append(layer)
+            layer = layer.base
+        return layers[::-1]
+
+    def __len__(self):
+        return self.num_base + self.count
+
+    def _locate(self, i: int) -> Tuple["CommitGraph", int]:
+        """
+        全局位置 i 转换为 (所在的层, 层内位置)
+        """
+        layer = self
+        while i < layer.num_base:
+            layer = layer.base
+        return layer, i - layer.num_base
+
+    def sha1_at(self, i: int) -> str:
+        layer, i = self._locate(i)
+        start = layer.oid_offset + 20 * i
+        return layer.data[start:start + 20].hex()
+
+    def find(self, sha1: str) -> [int, None]:
+        """
+        根据 sha1 查找 commit 的全局位置，先查本层再查下层，没有就返回 None
+        """
+        if len(sha1) != 40:
+            return None
+        key = bytes.fromhex(sha1)
+        layer = self
+        while layer is not None:
+            if layer.count:
+                lo = layer.fanout[key[0] - 1] if key[0] else 0
+                hi = layer.fanout[key[0]]
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    start = layer.oid_offset + 20 * mid
+                    if layer.data[start:start + 20] < key:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                start = layer.oid_offset + 20 * lo
+                if lo < layer.count and layer.data[start:start + 20] == key:
+                    return layer.num_base + lo
+            layer = layer.base
+        return None
+
+    def read_at(self, i: int) -> Tuple[str, List[int], int, int]:
+        """
+        读取全局位置 i 处的 commit，返回 (tree sha1, 父结点位置列表, generation, 提交时间)
+        """
+        layer, i = self._locate(i)
+        start = layer.cdat_offset + 36 * i
+        tree = layer.data[start:start + 20].hex()
+        parent1, parent2, high, low = struct.unpack_from('!LLLL', layer.data, start + 20)
+        parents = []
+        if parent1 != self.PARENT_NONE:
+            parents.append(parent1)
+        if parent2 & self.PARENT_EXTRA:
+            edge = layer.edge_offset + 4 * (parent2 & ~self.PARENT_EXTRA)
+            while True:
+                parent, = struct.unpack_from('!L', layer.data, edge)
+                parents.append(parent & ~self.PARENT_EXTRA)
+                if parent & self.PARENT_EXTRA:
+                    break
+                edge += 4
+        elif parent2 != self.PARENT_NONE:
+            parents.append(parent2)
+        return tree, parents, high >> 2, ((high & 0x3) << 32) | low
+
+    def get(self, sha1: str) -> [Tuple[str, List[str], int, int], None]:
+        """
+        根据 sha1 读取 commit，返回 (tree sha1, 父结点 sha1 列表, generation, 提交时间)，没有就返回 None
+        """
+        i = self.find(sha1)
+        if i is None:
+            return None
+        tree, parents, generation, commit_time = self.read_at(i)
+        return tree, [self.sha1_at(p) for p in parents], generation, commit_time
+
+    def generation(self, sha1: str) -> int:
+        i = self.find(sha1)
+        if i is None:
+            return self.GENERATION_INFINITY
+        layer, i = self._locate(i)
+        start = layer.cdat_offset + 36 * i + 28
+        return struct.unpack_from('!L', layer.data, start)[0] >> 2
+
+    @classmethod
+    def encode(cls, commits: dict, base: "CommitGraph" = None) -> bytes:
+        """
+        根据 {sha1: (tree sha1, 父结点 sha1 列表, 提交时间)} 生成一层 commit-graph 的内容，
+        父结点必须在 commits 或 base 中
+        """
+        num_base = len(base) if base else 0
+        order = sorted(commits)
+        positions = {sha1: num_base + i for i, sha1 in enumerate(order)}
+        for sha1 in order:
+            for p in commits[sha1][1]:
+                if p not in positions:
+                    positions[p] = base.find(p) if base else None
+                    assert positions[p] is not None, f"commit-graph 缺少 {sha1} 的父结点 {p}"
+        generations = {}
+        for root in order:
+            stack = [root]
+            while stack:
+                sha1 = stack[-1]
+                if sha1 in generations:
+                    stack.pop()
+                    continue
+                if sha1 not in commits:
+                    generations[sha1] = base.generation(sha1)
+                    stack.pop()
+                    continue
+                pending = [p for p in commits[sha1][1] if p not in generations]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                generations[sha1] = min(cls.GENERATION_MAX, 1 + max(
+                    (generations[p] for p in commits[sha1][1]), default=0))
+        fanout = [0] * 256
+        for sha1 in order:
+            fanout[int(sha1[:2], 16)] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        cdat, edges = [], []
+        for sha1 in order:
+            tree, parents, commit_time = commits[sha1]
+            parent_positions = [positions[p] for p in parents]
+            parent1 = parent_positions[0] if parent_positions else cls.PARENT_NONE
+            if len(parent_positions) > 2:
+                parent2 = cls.PARENT_EXTRA | len(edges)
+                edges.extend(parent_positions[1:-1])
+                edges.append(cls.PARENT_EXTRA | parent_positions[-1])
+            else:
+                parent2 = parent_positions[1] if len(parent_positions) == 2 else cls.PARENT_NONE
+            commit_time = min(commit_time, (1 << 34) - 1)
+            cdat.append(bytes.fromhex(tree) + struct.pack(
+                '!LLLL', parent1, parent2, (generations[sha1] << 2) | (commit_time >> 32), commit_time & 0xffffffff))
+        chunks = [
+            (b'OIDF', struct.pack('!256L', *fanout)),
+            (b'OIDL', b''.join(bytes.fromhex(sha1) for sha1 in order)),
+            (b'CDAT', b''.join(cdat)),
+        ]
+        if edges:
+            chunks.append((b'EDGE', struct.pack(f'!{len(edges)}L', *edges)))
+        base_layers = base.layers() if base else []
+        if base_layers:
+            chunks.append((b'BASE', b''.join(bytes.fromhex(layer.hash) for layer in base_layers)))
+        offset = 8 + 12 * (len(chunks) + 1)
+        header = [struct.pack('!4sBBBB', cls.SIGNATURE, 1, 1, len(chunks), len(base_layers))]
+        for chunk_id, chunk in chunks:
+            header.append(struct.pack('!4sQ', chunk_id, offset))
+            offset += len(chunk)
+        header.append(struct.pack('!4sQ', b'\x00' * 4, offset))
+        data = b''.join(header) + b''.join(chunk for _, chunk in chunks)
+        return data + hashlib.sha1(data).digest()
+
+    @classmethod
+    def write(cls, git_path: str, commits: dict) -> None:
+        """
+        把 {sha1: (tree sha1, 父结点 sha1 列表, 提交时间)} 写为只有一层的 split commit-graph，
+        commits 必须包含其中所有 commit 的父结点
+        """
+        with cls.lock_chain(git_path) as chain_file:
+            stale = cls.write_layer(git_path, chain_file, cls.encode(commits), [])
+        cls.remove_stale(stale)
+
+    @classmethod
+    def append(cls, git_path: str, commits: dict) -> bool:
+        """
+        把新的 commit 写为 split commit-graph 新的一层，只写入新 commit，不用重新遍历整个历史
+        新层的 commit 个数乘以 SPLIT_SIZE_MULTIPLE 不小于下一层时，把下一层的 commit 合并进来，重复直到不满足
+        取得 chain 的锁之后才重新读取各层，其它进程不能在读取和写入之间修改 chain；
+        此时只有单个 commit-graph 文件或父结点不都在 commit-graph 中时，chain 原样写回并返回 False
+        """
+        with cls.lock_chain(git_path) as chain_file:
+            base = cls.load(git_path)
+            if not base.is_split or any(base.find(p) is None for _, parents, _ in commits.values()
+                                        for p in parents if p not in commits):
+                chain_file.write(''.join(f"{h}\n" for h in cls.read_chain(git_path)).encode())
+                return False
+            commits = dict(commits)
+            while base is not None and len(commits) * cls.SPLIT_SIZE_MULTIPLE >= base.count:
+                for i in range(base.num_base, len(base)):
+                    sha1 = base.sha1_at(i)
+                    tree, parents, _, commit_time = base.get(sha1)
+                    commits.setdefault(sha1, (tree, parents, commit_time))
+                base = base.base
+            base_hashes = [layer.hash for layer in base.layers()] if base else []
+            stale = cls.write_layer(git_path, chain_file, cls.encode(commits, base), base_hashes)
+        cls.remove_stale(stale)
+        return True
+
+    @staticmethod
+    def lock_chain(git_path: str):
+        """
+        以 commit-graph-chain.lock 作为 commit-graph 的锁，在 with 中写入新的 chain，结束时替换 chain
+        """
+        graphs_path = os.path.join(git_path, "objects", "info", "commit-graphs")
+        os.makedirs(graphs_path, exist_ok=True)
+        return lock_file(os.path.join(graphs_path, "commit-graph-chain"))
+
+    @staticmethod
+    def write_layer(git_path: str, chain_file, data: bytes, base_hashes: List[str]) -> List[str]:
+        """
+        持有 chain 的锁时写入新的一层，新的 chain 写入 chain_file，锁释放时生效
+        返回不在新 chain 中的旧层和单个 commit-graph 文件，由 remove_stale 在新 chain 生效后删除；
+        只包含持有锁时已经存在的文件，之后其它进程写入的层不会被删除
+        """
+        info_path = os.path.join(git_path, "objects", "info")
+        graphs_path = os.path.join(info_path, "commit-graphs")
+        graph_hash = data[-20:].hex()
+        with lock_file(os.path.join(graphs_path, f"graph-{graph_hash}.graph")) as f:
+            f.write(data)
+        chain = base_hashes + [graph_hash]
+        chain_file.write(''.join(f"{h}\n" for h in chain).encode())
+        stale = [os.path.join(graphs_path, name) for name in os.listdir(graphs_path)
+                 if name.startswith("graph-") and name.endswith(".graph") and name[6:-6] not in chain]
+        if os.path.exists(os.path.join(info_path, "commit-graph")):
+            stale.append(os.path.join(info_path, "commit-graph"))
+        return stale
+
+    @staticmethod
+    def remove_stale(paths: List[str]) -> None:
+        # 其它进程取得锁时这些文件还没删除，也可能在它的列表中，已被删除时忽略
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
 class HashObject:
     """
     格式化 git 对象, git 对象存储在 .git/objects 目录中
@@ -26,10 +1011,13 @@ class HashObject:
     decompress:
         根据 sha1 值寻找 objects 存储的文件，根据压缩规则解析并返回其中的内容
     find_object:
-        根据hash值找到对象的存储路径
+        根据hash值找到松散对象的存储路径
+    read_object:
+        根据hash值在 pack 或松散对象中读取对象类型和内容
     """
 
     TYPE = None
+    cache = ObjectCache(OBJECT_CACHE_BYTES)
 
     def __init__(self, git_path: str = ""):
         if git_path:
@@ -37,14 +1025,37 @@ class HashObject:
         else:
             self.git_path = find_path()
         self.objs_path = os.path.join(self.git_path, "objects")
+        self._packs = None
+
+    @property
+    def packs(self) -> List[Pack]:
+        """
+        .git/objects/pack 中所有带 .idx 的 pack，第一次访问时加载
+        """
+        if self._packs is None:
+            pack_dir = os.path.join(self.objs_path, "pack")
+            tracing.count("fs.listdir")
+            try:
+                names = sorted(os.listdir(pack_dir))
+            except FileNotFoundError:
+                names = []
+            self._packs = [Pack(os.path.join(pack_dir, name)) for name in names if name.endswith(".idx")]
+        return self._packs
 
     def find_object(self, sha1: str):
         """
-        根据 sha1 值找到对象并返回其目录
+        根据 sha1 值找到松散对象并返回其目录，完整的 sha1 直接拼接路径，只有前缀才需要列出目录
         """
         if len(sha1) < 2:
             raise ValueError("sha1 至少拥有两个字节")
         obj_dir = os.path.join(self.git_path, "objects", sha1[:2])
+        if len(sha1) == 40:
+            path = os.path.join(obj_dir, sha1[2:])
+            tracing.count("fs.stat")
+            if not os.path.exists(path):
+                raise ValueError(f"未找到对象 {sha1}")
+            return path
+        tracing.count("fs.listdir")
         objects = [name for name in os.listdir(obj_dir) if name.startswith(sha1[2:])]
         if not objects:
             raise ValueError(f"未找到对象 {sha1}")
@@ -52,6 +1063,87 @@ class HashObject:
             raise ValueError(f"根据 {sha1} 找到多个对象 {len(objects)}")
         return os.path.join(obj_dir, objects[0])
 
+    def resolve_sha1(self, sha1: str) -> str:
+        """
+        将 sha1 前缀扩展为完整的 sha1，同时在 pack 和松散对象中查找
+        """
+        if len(sha1) == 40:
+            return sha1
+        matches = set()
+        for pack in self.packs:
+            matches.update(pack.index.find_prefix(sha1))
+        try:
+            path = self.find_object(sha1)
+            matches.add(os.path.basename(os.path.dirname(path)) + os.path.basename(path))
+        except (ValueError, FileNotFoundError):
+            pass
+        if not matches:
+            raise ValueError(f"未找到对象 {sha1}")
+        if len(matches) >= 2:
+            raise ValueError(f"根据 {sha1} 找到多个对象 {len(matches)}")
+        return matches.pop()
+
+    def has_object(self, sha1: str) -> bool:
+        """
+        判断完整 sha1 对应的对象是否已存在于 pack 或松散对象中
+        """
+        if any(pack.find(sha1) is not None for pack in self.packs):
+            return True
+        tracing.count("fs.stat")
+        return os.path.exists(os.path.join(self.objs_path, sha1[:2], sha1[2:]))
+
+    def read_object(self, sha1: str) -> Tuple[str, bytes]:
+        """
+        根据 sha1 值读取对象，返回 (对象类型, 对象内容)
+        先查询 ObjectCache，未命中时优先通过 idx 在 pack 中查找，找不到再读取松散对象
+        """
+        sha1 = self.resolve_sha1(sha1)
+        item = self.cache.get(sha1)
+        if item is None:
+            item = self._read_object(sha1)
+            self.cache.put(sha1, item)
+        return item
+
+    def _read_object(self, sha1: str) -> Tuple[str, bytes]:
+        for pack in self.packs:
+            offset = pack.find(sha1)
+            if offset is not None:
+                return pack.read(offset, self.read_object)
+        full_data = zlib.decompress(read_file(self.find_object(sha1)))
+        tracing.count("objects.inflated")
+        tracing.count("zlib.bytes_inflated", len(full_data))
+
+        nul_index = full_data.index(b'\x00')
+        header = full_data[:nul_index]
+
+        obj_type, size_str = header.decode().split()
+        size = int(size_str)
+        data = full_data[nul_index + 1:]
+
+        assert size == len(data), f"数据长度应为 {size}, 得到 {len(data)} bytes"
+
+        return obj_type, data
+
+    def read_info(self, sha1: str) -> Tuple[str, int]:
+        """
+        只解析对象头部，返回 (对象类型, 对象长度)，不解压完整内容
+        """
+        sha1 = self.resolve_sha1(sha1)
+        for pack in self.packs:
+            offset = pack.find(sha1)
+            if offset is not None:
+                return pack.read_info(offset, self.read_info)
+        decompressor = zlib.decompressobj()
+        header = b''
+        with open(self.find_object(sha1), "rb") as f:
+            while b'\x00' not in header:
+                chunk = f.read(64)
+                if not chunk:
+                    raise ValueError(f"对象头部不完整 {sha1}")
+                header += decompressor.decompress(chunk)
+        obj_type, size_str = header[:header.index(b'\x00')].decode().split()
+        return obj_type, int(size_str)
+
     @singledispatchmethod
     def compress(self, arg):
         """
@@ -66,37 +1158,78 @@ class HashObject:
         sha1 = hashlib.sha1(full_data).hexdigest()
         path = os.path.join(self.objs_path, sha1[:2], sha1[2:])
 
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-
-        if os.path.exists(path):
+        tracing.count("objects.hashed")
+        if self.has_object(sha1):
             return sha1
 
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
         write_file(path, zlib.compress(full_data))
+        tracing.count("objects.written")
+        tracing.count("zlib.bytes_deflated", len(full_data))
         return sha1
 
+    def hash_file(self, path: str) -> str:
+        """
+        只计算文件作为 git 对象的 sha1 值，不写入 objects 目录
+        """
+        assert self.TYPE, f"类型错误 {self.TYPE}"
+        return self._stream(path)
+
     @compress.register
     def _(self, path: str) -> str:
+        """
+        分块读取文件，边计算 sha1 边压缩写入临时文件，最后重命名到对象路径，
+        内存中只保留一个分块，不会读取整个文件
+        """
         assert self.TYPE, f"类型错误 {self.TYPE}"
-        data = read_file(path)
-        return self.compress(data)
+        with temp_file(self.objs_path, "tmp_obj_") as f:
+            sha1 = self._stream(path, f)
+            if not self.has_object(sha1):
+                f.target = os.path.join(self.objs_path, sha1[:2], sha1[2:])
+                os.makedirs(os.path.dirname(f.target), exist_ok=True)
+                tracing.count("objects.written")
+        return sha1
+
+    def _stream(self, path: str, out=None) -> str:
+        """
+        以 CHUNK_SIZE 分块读取文件并计算 sha1，若 out 不为空则同时将压缩数据写入 out
+        对象头部中的长度通过 stat 获取，读取过程中文件大小发生变化则抛出异常
+        """
+        size = os.stat(path).st_size
+        tracing.count("fs.stat")
+        tracing.count("objects.hashed")
+        if out:
+            tracing.count("zlib.bytes_deflated", size)
+        head = self._build_head(self.TYPE, size)
+        sha1 = hashlib.sha1(head)
+        compressor = zlib.compressobj() if out else None
+        if out:
+            out.write(compressor.compress(head))
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        total = 0
+        with open(path, "rb") as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                total += n
+                sha1.update(view[:n])
+                if out:
+                    out.write(compressor.compress(view[:n]))
+        if total != size:
+            raise ValueError(f"文件 {path} 在读取过程中被修改")
+        if out:
+            out.write(compressor.flush())
+        return sha1.hexdigest()
 
     def decompress(self, sha1: str) -> bytes:
         """
         解析 blob 数据，校验数据类型和大小，防止读取被修改过的文件
         """
         assert self.TYPE, f"类型错误 {self.TYPE}"
-        path = self.find_object(sha1)
-        full_data = zlib.decompress(read_file(path))
-
-        nul_index = full_data.index(b'\x00')
-        header = full_data[:nul_index]
-
-        obj_type, size_str = header.decode().split()
-        size = int(size_str)
-        data = full_data[nul_index + 1:]
-
-        assert size == len(data), f"数据长度应为 {size}, 得到 {len(data)} bytes"
+        obj_type, data = self.read_object(sha1)
         assert obj_type == self.TYPE, f"数据类型应为 {self.TYPE}，得到 {obj_type}"
 
         return data
@@ -119,6 +1252,13 @@ class Blob(HashObject):
 
 class Commit(HashObject):
     TYPE = "commit"
+    WALK_SLOP = 5
+    STALE = 4
+    BITMAP_RECENT = 1000
+
+    def __init__(self, git_path: str = ""):
+        super().__init__(git_path)
+        self._graph = None
 
     def get_master_path(self):
         master_path = os.path.join(self.git_path, "refs", "heads", "master")
@@ -134,24 +1274,339 @@ class Commit(HashObject):
         except FileNotFoundError:
             return None
 
+    def read_commit(self, commit_sha1) -> Tuple[str, List[str]]:
+        """
+        解析 commit 头部，返回 (tree sha1, parent sha1 列表)
+        """
+        tree, parents, _ = self.read_commit_info(commit_sha1)
+        return tree, parents
+
+    @property
+    def graph(self) -> CommitGraph:
+        """
+        .git/objects/info 下的 commit-graph，第一次访问时加载
+        """
+        if self._graph is None:
+            self._graph = CommitGraph.load(self.git_path)
+        return self._graph
+
+    def read_commit_info(self, commit_sha1) -> Tuple[str, List[str], int]:
+        """
+        解析 commit 头部，返回 (tree sha1, parent sha1 列表, 提交时间戳)
+        commit 在 commit-graph 中时直接读取，不需要解压 commit 对象
+        """
+        entry = self.graph.get(commit_sha1)
+        if entry is not None:
+            tree, parents, _, commit_time = entry
+            return tree, parents, commit_time
+        commit = self.decompress(commit_sha1)
+        tree, parents, commit_time = None, [], 0
+        for line in commit[:commit.find(b'\n\n')].decode().splitlines():
+            if line.startswith('tree '):
+                tree = line[5:45]
+            elif line.startswith('parent '):
+                parents.append(line[7:47])
+            elif line.startswith('committer '):
+                commit_time = self.parse_commit_time(line)
+        return tree, parents, commit_time
+
+    @staticmethod
+    def parse_commit_time(line: str) -> int:
+        """
+        解析 committer 行中的时间戳，兼容 git 的 `<email> 时间戳 时区` 格式
+        和 commit 命令写入的 `%Y-%m-%d %H:%M:%S` 格式，无法解析时返回 0
+        """
+        fields = line.split()
+        if len(fields) >= 2 and fields[-2].isdigit():
+            return int(fields[-2])
+        try:
+            return int(time.mktime(time.strptime(' '.join(fields[-2:]), "%Y-%m-%d %H:%M:%S")))
+        except ValueError:
+            return 0
+
     def find_commit_objects(self, commit_sha1, tree_obj):
         objects = {commit_sha1}
-        commit = self.decompress(commit_sha1)
-        lines = commit.decode().splitlines()
-        tree = next(l[5:45] for l in lines if l.startswith('tree '))
+        tree, parents = self.read_commit(commit_sha1)
         objects.update(tree_obj.find_tree_objects(tree))
-        parents = (l[7:47] for l in lines if l.startswith('parent '))
         for parent in parents:
             objects.update(self.find_commit_objects(parent, tree_obj))
         return objects
 
+    def find_named_objects(self, commit_sha1, tree_obj) -> dict:
+        """
+        迭代遍历 commit 可达的全部对象，返回 {sha1: 路径名}，commit 和根 tree 的路径名为空
+        路径名用于打包时把同名文件排在一起，便于找到相似的 delta base
+        """
+        names = {}
+        commits = [commit_sha1]
+        while commits:
+            sha1 = commits.pop()
+            if sha1 in names:
+                continue
+            names[sha1] = ''
+            tree, parents = self.read_commit(sha1)
+            tree_obj.find_named_tree_objects(tree, names)
+            commits.extend(parents)
+        return names
+
     def find_missing_objects(self, local_sha1, remote_sha1):
-        tree = Tree()
-        local_objects = self.find_commit_objects(local_sha1, tree)
-        if remote_sha1 is None:
-            return local_objects
-        remote_objects = self.find_commit_objects(remote_sha1, tree)
-        return local_objects - remote_objects
+        """
+        找到本地 master 可达而远程 master 不可达的对象，返回 {sha1: 路径名}
+        有 bitmap 的 pack 时直接用位图计算 (路径名为路径名 hash)；
+        否则先用 find_missing_commits 找到差异的 commit，再遍历它们的 tree，
+        边界 commit 的 tree 中的对象远程已经拥有，遍历时直接跳过
+        """
+        tree_obj = Tree(self.git_path)
+        if remote_sha1 and not self.has_object(remote_sha1):
+            remote_sha1 = None
+        for pack in self.packs:
+            if pack.bitmap is not None:
+                return pack.bitmap.find_missing(local_sha1, remote_sha1, self, tree_obj)
+        commits, edges = self.find_missing_commits(local_sha1, remote_sha1)
+        have = {}
+        for sha1 in edges:
+            tree_obj.find_named_tree_objects(self.read_commit(sha1)[0], have)
+        missing = {}
+        for sha1 in commits:
+            missing[sha1] = ''
+            tree_obj.find_named_tree_objects(self.read_commit(sha1)[0], missing, have)
+        return missing
+
+    def find_missing_commits(self, local_sha1, remote_sha1) -> Tuple[List[str], Set[str]]:
+        """
+        返回 (local_sha1 可达而 remote_sha1 不可达的 commit 列表, 与它们相邻的远程已有 commit)
+        用优先队列按提交时间从新到旧遍历，remote_sha1 可达的 commit 标记为 uninteresting 并传递给父结点，
+        队列中只剩 uninteresting 的 commit 时 (再多走 WALK_SLOP 步) 停止，耗时只与两者之间的差异有关
+        """
+        uninteresting = set()
+        seen = set()
+        pending = set()
+        queue = []
+        counter = itertools.count()
+        interesting_queued = 0
+
+        def push(sha1, mark):
+            nonlocal interesting_queued
+            if mark and sha1 not in uninteresting:
+                uninteresting.add(sha1)
+                if sha1 in pending:
+                    interesting_queued -= 1
+                elif sha1 in seen:
+                    # 已经当作 interesting 处理过，重新入队把标记传递给父结点
+                    pending.add(sha1)
+                    heapq.heappush(queue, (-self.read_commit_info(sha1)[2], next(counter), sha1))
+            if sha1 in seen:
+                return
+            seen.add(sha1)
+            pending.add(sha1)
+            if sha1 not in uninteresting:
+                interesting_queued += 1
+            heapq.heappush(queue, (-self.read_commit_info(sha1)[2], next(counter), sha1))
+
+        push(local_sha1, False)
+        if remote_sha1:
+            push(remote_sha1, True)
+        commits, parents_of = [], {}
+        slop = self.WALK_SLOP
+        while queue and slop:
+            # 队列中没有 interesting 的 commit 后再多处理 WALK_SLOP 个，应对提交时间的时钟偏差
+            slop = self.WALK_SLOP if interesting_queued else slop - 1
+            _, _, sha1 = heapq.heappop(queue)
+            pending.discard(sha1)
+            mark = sha1 in uninteresting
+            if not mark:
+                interesting_queued -= 1
+            parents = self.read_commit(sha1)[1]
+            if not mark:
+                commits.append(sha1)
+                parents_of[sha1] = parents
+            for parent in parents:
+                push(parent, mark)
+        # 时钟偏差可能使 commit 先被当作 interesting 处理，之后才被标记为 uninteresting
+        commits = [sha1 for sha1 in dict.fromkeys(commits) if sha1 not in uninteresting]
+        edges = {p for sha1 in commits for p in parents_of[sha1] if p in uninteresting}
+        if remote_sha1:
+            edges.add(remote_sha1)
+        return commits, edges
+
+    def write_commit_graph(self, heads: List[str]) -> int:
+        """
+        遍历 heads 可达的全部 commit 写入 commit-graph，已在 commit-graph 中的 commit 不需要解压
+        返回写入的 commit 个数
+        """
+        commits = {}
+        stack = list(heads)
+        while stack:
+            sha1 = stack.pop()
+            if sha1 in commits:
+                continue
+            commits[sha1] = self.read_commit_info(sha1)
+            stack.extend(commits[sha1][1])
+        CommitGraph.write(self.git_path, commits)
+        self._graph = None
+        return len(commits)
+
+    def append_commit_graph(self, sha1: str) -> bool:
+        """
+        把新的 commit 追加为 commit-graph 新的一层，不重新遍历历史
+        父结点不都在 commit-graph 中，是单个 commit-graph 文件，或者其它进程正持有 chain 的锁时不写入，
+        留给 gc 或 commit-graph 命令重写，返回是否写入
+        """
+        graph = self.graph
+        if graph.find(sha1) is not None:
+            return True
+        tree, parents, commit_time = self.read_commit_info(sha1)
+        if not graph.is_split or any(graph.find(p) is None for p in parents):
+            return False
+        self._graph = None
+        try:
+            return CommitGraph.append(self.git_path, {sha1: (tree, parents, commit_time)})
+        except FileExistsError:
+            return False
+
+    def write_pack_bitmap(self, pack_sha1: str, tip: str, names: dict) -> int:
+        """
+        为 pack-<pack_sha1> 生成 .bitmap 文件，从 tip 开始按提交时间从新到旧，
+        最近 BITMAP_RECENT 个 commit 每隔 10 个、其余每隔 100 个选一个 commit 保存位图
+        返回位图个数
+        """
+        pack = Pack(os.path.join(self.objs_path, "pack", f"pack-{pack_sha1}.idx"))
+        selected = [sha1 for i, sha1 in enumerate(self.iter_history(tip))
+                    if i % (10 if i < self.BITMAP_RECENT else 100) == 0]
+        PackBitmap(pack).write(selected, names, self, Tree(self.git_path))
+        self._packs = None
+        return len(selected)
+
+    def is_ancestor(self, ancestor: str, descendant: str) -> bool:
+        """
+        判断 ancestor 是否可以从 descendant 到达
+        generation 小于 ancestor 的 commit 不可能到达 ancestor，遍历时直接剪掉
+        """
+        min_generation = self.graph.generation(ancestor)
+        stack, seen = [descendant], set()
+        while stack:
+            sha1 = stack.pop()
+            if sha1 == ancestor:
+                return True
+            if sha1 in seen:
+                continue
+            seen.add(sha1)
+            stack.extend(p for p in self.read_commit(sha1)[1] if self.graph.generation(p) >= min_generation)
+        return False
+
+    def merge_base(self, sha1_a: str, sha1_b: str) -> List[str]:
+        """
+        找到两个 commit 的最近公共祖先
+        按 (generation, 提交时间) 从大到小向下染色，同时被两边染色的 commit 为候选，其祖先标记为 STALE，
+        队列中只剩 STALE 的 commit 时停止，最后去掉是其他候选祖先的候选
+        """
+        if sha1_a == sha1_b:
+            return [sha1_a]
+        flags = {sha1_a: 1, sha1_b: 2}
+        queue = []
+        counter = itertools.count()
+
+        def push(sha1):
+            priority = (-self.graph.generation(sha1), -self.read_commit_info(sha1)[2], next(counter))
+            heapq.heappush(queue, priority + (sha1,))
+
+        push(sha1_a)
+        push(sha1_b)
+        result = []
+        while any(not flags[item[-1]] & self.STALE for item in queue):
+            sha1 = heapq.heappop(queue)[-1]
+            flag = flags[sha1]
+            if flag & 3 == 3 and not flag & self.STALE:
+                result.append(sha1)
+                flag |= self.STALE
+                flags[sha1] = flag
+            for parent in self.read_commit(sha1)[1]:
+                if flags.get(parent, 0) & flag == flag:
+                    continue
+                flags[parent] = flags.get(parent, 0) | flag
+                push(parent)
+        return [sha1 for sha1 in result
+                if not any(other != sha1 and self.is_ancestor(sha1, other) for other in result)]
+
+    def iter_history(self, commit_sha1: str):
+        """
+        按提交时间从新到旧生成 commit_sha1 可达的全部 commit
+        """
+        queue = [(-self.read_commit_info(commit_sha1)[2], commit_sha1)]
+        seen = {commit_sha1}
+        while queue:
+            _, sha1 = heapq.heappop(queue)
+            yield sha1
+            for parent in self.read_commit(sha1)[1]:
+                if parent not in seen:
+                    seen.add(parent)
+                    heapq.heappush(queue, (-self.read_commit_info(parent)[2], parent))
+
+    def find_edge_objects(self, commit_sha1, tree_obj) -> dict:
+        """
+        获取 commit 的 tree 中的全部对象，返回 {路径名: sha1}
+        远程已经拥有这些对象，push 时可以作为 thin pack 中 REF_DELTA 的 base
+        """
+        tree, _ = self.read_commit(commit_sha1)
+        return {name: sha1 for sha1, name in tree_obj.find_named_tree_objects(tree, {}).items()}
+
+
+class CacheTree:
+    """
+    .git/index 的 TREE 扩展，记录每个目录对应的 tree sha1 和目录下的索引个数
+    按先序遍历保存每个目录 [目录名 NUL, 索引个数 空格 子目录个数 \n, tree 的 sha1]，
+    索引个数为 -1 时表示目录中有文件变动，此时不保存 sha1
+    commit 时没有变动的目录直接使用记录的 sha1，只重新生成有变动的目录的 tree
+    """
+
+    def __init__(self, entry_count: int = -1, sha1: str = None):
+        self.entry_count = entry_count
+        self.sha1 = sha1
+        self.children = {}
+
+    @classmethod
+    def parse(cls, data: [bytes, None]) -> "CacheTree":
+        if not data:
+            return cls()
+
+        def read(start: int):
+            end = data.find(b'\x00', start)
+            line_end = data.find(b'\n', end)
+            entry_count, subtree_count = map(int, data[end + 1:line_end].split(b' '))
+            node = cls(entry_count)
+            pos = line_end + 1
+            if entry_count >= 0:
+                node.sha1 = data[pos:pos + 20].hex()
+                pos += 20
+            for _ in range(subtree_count):
+                name, child, pos = read(pos)
+                node.children[name] = child
+            return data[start:end].decode(), node, pos
+
+        return read(0)[1]
+
+    def encode(self, name: bytes = b'') -> bytes:
+        """
+        和 git 一样，子目录按 (名称长度, 名称) 排序
+        """
+        parts = [name, b'\x00', f"{self.entry_count} {len(self.children)}\n".encode()]
+        if self.entry_count >= 0:
+            parts.append(bytes.fromhex(self.sha1))
+        for child_name in sorted((name.encode() for name in self.children), key=lambda n: (len(n), n)):
+            parts.append(self.children[child_name.decode()].encode(child_name))
+        return b''.join(parts)
+
+    def invalidate(self, path: str) -> None:
+        """
+        path 对应的文件有变动，将其所在的各级目录设为失效
+        """
+        node = self
+        node.entry_count = -1
+        for name in path.split('/')[:-1]:
+            node = node.children.get(name)
+            if node is None:
+                return
+            node.entry_count = -1
 
 
 class Tree(HashObject):
@@ -165,33 +1620,82 @@ class Tree(HashObject):
         super().__init__(path)
         self.index = Index(path)
 
-    def write_tree(self):
+    def write_tree(self) -> str:
+        """
+        根据 .git/index 文件生成各级目录的 tree，返回根目录 tree 的 sha1
+        index 的 TREE 扩展中仍然有效的目录直接使用记录的 sha1，生成的新 tree 再写回 TREE 扩展
         """
-        根据 .git/index 文件生成 tree
+        table = self.index.table()
+        if table.cache_tree.entry_count < 0:
+            entries = list(table)
+            self._write_subtree(entries, 0, len(entries), '', table.cache_tree)
+            self.index.write_index(table)
+        return table.cache_tree.sha1
+
+    def _write_subtree(self, entries: List[IndexEntry], start: int, end: int, prefix: str, node: CacheTree):
+        """
+        entries[start:end] 是 prefix 目录下的全部索引，生成这个目录的 tree 并记录到 node
+        index 按 path 排序，同一个子目录下的索引是连续的，其顺序也就是 tree 中要求的顺序
         """
         tree_entries = []
-        for entry in self.index.read_index():
-            assert '/' not in entry.path
-            mode_path = '{:o} {}'.format(entry.mode, entry.path).encode()
-            tree_entry = mode_path + b'\x00' + entry.sha1
-            tree_entries.append(tree_entry)
-        return self.compress(b''.join(tree_entries))
+        children = {}
+        i = start
+        while i < end:
+            path = entries[i].path[len(prefix):]
+            name, slash, _ = path.partition('/')
+            if not slash:
+                tree_entries.append('{:o} {}'.format(entries[i].mode, name).encode() + b'\x00' + entries[i].sha1)
+                i += 1
+                continue
+            sub_prefix = prefix + name + '/'
+            j = i + 1
+            while j < end and entries[j].path.startswith(sub_prefix):
+                j += 1
+            child = node.children.get(name) or CacheTree()
+            if child.entry_count < 0:
+                self._write_subtree(entries, i, j, sub_prefix, child)
+            children[name] = child
+            tree_entries.append('40000 {}'.format(name).encode() + b'\x00' + bytes.fromhex(child.sha1))
+            i = j
+        node.children = children
+        node.entry_count = end - start
+        node.sha1 = self.compress(b''.join(tree_entries))
 
     def read_tree(self, sha1: str):
         data = self.decompress(sha1)
         i = 0
         entries = []
-        for _ in range(1000):
+        while i < len(data):
             end = data.find(b'\x00', i)
             if end == -1:
                 break
-            mode_str, path = data[i:end].decode().split()
+            mode_str, _, path = data[i:end].decode().partition(' ')
             mode = int(mode_str, 8)
             digest = data[end + 1:end + 21]
             entries.append((mode, path, digest.hex()))
             i = end + 1 + 20
         return entries
 
+    def find_named_tree_objects(self, tree_sha1, names: dict, exclude: dict = None) -> dict:
+        """
+        迭代遍历 tree 中的全部对象，将 {sha1: 路径名} 加入 names 并返回
+        已在 names 中的 tree 不再展开，exclude 中的对象及其子对象全部跳过
+        """
+        exclude = exclude or {}
+        trees = [(tree_sha1, '')]
+        while trees:
+            sha1, name = trees.pop()
+            if sha1 in names or sha1 in exclude:
+                continue
+            names[sha1] = name
+            for mode, path, obj_sha1 in self.read_tree(sha1):
+                path = f"{name}/{path}" if name else path
+                if stat.S_ISDIR(mode):
+                    trees.append((obj_sha1, path))
+                elif obj_sha1 not in exclude:
+                    names.setdefault(obj_sha1, path)
+        return names
+
     def find_tree_objects(self, tree_sha1):
         objects = {tree_sha1}
         for mode, path, sha1 in self.read_tree(sha1=tree_sha1):
@@ -206,6 +1710,380 @@ class Tag(HashObject):
     TYPE = "tag"
 
 
+class HashEngine:
+    """
+    基于线程池并行计算文件的 sha1 值, add/status/diff 共用
+    hashlib 和 zlib 在处理大块数据时会释放 GIL，因此线程池即可利用多核
+    concurrent.futures 会引入 logging 等模块，只在需要并行时才导入
+    compress:
+        并行压缩文件写入 objects 目录，按输入顺序返回 sha1 值
+    hash:
+        并行计算文件的 sha1 值，不写入 objects 目录
+    """
+
+    def __init__(self, hash_obj: HashObject, workers: int = 0):
+        self.hash_obj = hash_obj
+        self.workers = workers or HASH_WORKERS
+
+    def _map(self, func, paths: List[str]) -> List[str]:
+        if self.workers <= 1 or len(paths) <= 1:
+            return [func(path) for path in paths]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(paths))) as executor:
+            return list(executor.map(func, paths))
+
+    def compress(self, paths: List[str]) -> List[str]:
+        return self._map(self.hash_obj.compress, paths)
+
+    def hash(self, paths: List[str]) -> List[str]:
+        return self._map(self.hash_obj.hash_file, paths)
+
+
+class IndexView:
+    """
+    通过 mmap 读取 .git/index 文件，只记录每条索引在文件中的偏移量，访问时才解析字段
+    索引按 path 排好序，find/get 通过二分查找定位，不需要解析全部索引
+    verify 为 True 时才校验文件末尾的 sha1
+    """
+
+    ENTRY_FORMAT = '!LLLLLLLLLL20sH'
+
+    def __init__(self, path: str, verify: bool = False):
+        self.offsets = []
+        self.data = b''
+        try:
+            with open(path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return
+        if verify:
+            digest = hashlib.sha1(memoryview(self.data)[:-20]).digest()
+            assert digest == self.data[-20:], 'index 文件非法'
+        signature, version, num_entries = struct.unpack_from('!4sLL', self.data, 0)
+        assert signature == b'DIRC', f"签名不合法 {signature}"
+        assert version == 2, f"版本不合法 {version}"
+        # 根据 flags 中记录的 path 长度计算下一条索引的位置，只读取每条索引的 2 个字节
+        offset = 12
+        offsets = self.offsets
+        for _ in range(num_entries):
+            offsets.append(offset)
+            name_length = struct.unpack_from('!H', self.data, offset + 60)[0] & 0xfff
+            if name_length == 0xfff:
+                name_length = self.data.find(b'\x00', offset + 62) - offset - 62
+            offset += ((62 + name_length + 8) // 8) * 8
+        self.extensions_offset = offset
+        tracing.count("index.entries_parsed", num_entries)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i: int) -> IndexEntry:
+        offset = self.offsets[i]
+        fields = struct.unpack_from(self.ENTRY_FORMAT, self.data, offset)
+        return IndexEntry(*(fields + (self._path_bytes(offset).decode(),)))
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self[i]
+
+    def _path_bytes(self, offset: int) -> bytes:
+        end = self.data.find(b'\x00', offset + 62)
+        return self.data[offset + 62:end]
+
+    def path_at(self, i: int) -> str:
+        return self._path_bytes(self.offsets[i]).decode()
+
+    def iter_paths(self):
+        for offset in self.offsets:
+            yield self._path_bytes(offset).decode()
+
+    def sha1_at(self, i: int) -> bytes:
+        offset = self.offsets[i] + 40
+        return self.data[offset:offset + 20]
+
+    def find(self, path: str) -> [int, None]:
+        """
+        二分查找 path 在索引中的位置，没有就返回 None
+        """
+        key = path.encode()
+        lo, hi = 0, len(self.offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path_bytes(self.offsets[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.offsets) and self._path_bytes(self.offsets[lo]) == key:
+            return lo
+        return None
+
+    def get(self, path: str) -> [IndexEntry, None]:
+        i = self.find(path)
+        return None if i is None else self[i]
+
+    def extensions(self) -> dict:
+        """
+        解析索引之后的扩展数据，返回 {扩展签名: 扩展内容}
+        """
+        result = {}
+        offset = self.extensions_offset
+        while offset + 8 <= len(self.data) - 20:
+            signature, size = struct.unpack_from('!4sL', self.data, offset)
+            result[signature] = self.data[offset + 8:offset + 8 + size]
+            offset += 8 + size
+        return result
+
+
+class IndexTable:
+    """
+    列式存储的内存索引，用于修改索引后写回 .git/index
+    ctime_s 到 size 这 10 个数值字段各用一个 array 保存，和 git 一样只保存低 32 位，sha1 连续保存在一个 bytearray 中，
+    path 保存在排好序的列表中，通过二分查找定位，插入和删除只移动数组中的数据，不创建 IndexEntry 对象
+    """
+
+    FIELDS = IndexEntry._fields[:10]
+
+    def __init__(self):
+        self.columns = [array('I') for _ in self.FIELDS]
+        self.sha1s = bytearray()
+        self.flags = array('H')
+        self.paths = []
+        self.cache_tree = CacheTree()
+        self.fsmonitor = None
+
+    @classmethod
+    def from_view(cls, view: IndexView, start: int = 0) -> "IndexTable":
+        table = cls()
+        data = view.data
+        for offset in view.offsets[start:]:
+            fields = struct.unpack_from('!10L', data, offset)
+            for column, value in zip(table.columns, fields):
+                column.append(value)
+            table.sha1s += data[offset + 40:offset + 60]
+            table.flags.append(struct.unpack_from('!H', data, offset + 60)[0])
+            table.paths.append(view._path_bytes(offset))
+        tracing.count("index.entries_unpacked", len(table))
+        return table
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i: int) -> IndexEntry:
+        return IndexEntry(*[column[i] for column in self.columns], bytes(self.sha1s[20 * i:20 * i + 20]),
+                          self.flags[i], self.paths[i].decode())
+
+    def __iter__(self):
+        for i in range(len(self.paths)):
+            yield self[i]
+
+    def iter_paths(self):
+        for path in self.paths:
+            yield path.decode()
+
+    def find(self, path: str) -> [int, None]:
+        key = path.encode()
+        i = bisect.bisect_left(self.paths, key)
+        if i < len(self.paths) and self.paths[i] == key:
+            return i
+        return None
+
+    def get(self, path: str) -> [IndexEntry, None]:
+        i = self.find(path)
+        return None if i is None else self[i]
+
+    def upsert(self, entry: IndexEntry) -> None:
+        """
+        插入或更新一条索引，保持 path 有序
+        """
+        key = entry.path.encode()
+        i = bisect.bisect_left(self.paths, key)
+        if i < len(self.paths) and self.paths[i] == key:
+            if self.sha1s[20 * i:20 * i + 20] != entry.sha1 or self.columns[6][i] != entry.mode:
+                self.cache_tree.invalidate(entry.path)
+            for column, value in zip(self.columns, entry):
+                column[i] = value & 0xffffffff
+            self.sha1s[20 * i:20 * i + 20] = entry.sha1
+            self.flags[i] = entry.flags
+            return
+        self.cache_tree.invalidate(entry.path)
+        for column, value in zip(self.columns, entry):
+            column.insert(i, value & 0xffffffff)
+        self.sha1s[20 * i:20 * i] = entry.sha1
+        self.flags.insert(i, entry.flags)
+        self.paths.insert(i, key)
+
+    def update(self, entries: List[IndexEntry]) -> None:
+        """
+        批量插入或更新索引，新增的索引排序后和现有索引一次合并，避免逐条插入时反复移动各列的数据
+        """
+        new = {}
+        for entry in entries:
+            if self.find(entry.path) is None:
+                new[entry.path] = entry
+            else:
+                self.upsert(entry)
+        if not new:
+            return
+        for path in new:
+            self.cache_tree.invalidate(path)
+        key = lambda entry: entry.path.encode()
+        merged = IndexTable.from_entries(heapq.merge(self, sorted(new.values(), key=key), key=key))
+        self.columns, self.sha1s, self.flags, self.paths = merged.columns, merged.sha1s, merged.flags, merged.paths
+
+    @classmethod
+    def from_entries(cls, entries) -> "IndexTable":
+        """
+        从按 path 排好序的 IndexEntry 生成
+        """
+        table = cls()
+        for entry in entries:
+            for column, value in zip(table.columns, entry):
+                column.append(value & 0xffffffff)
+            table.sha1s += entry.sha1
+            table.flags.append(entry.flags)
+            table.paths.append(entry.path.encode())
+        return table
+
+    def remove(self, path: str) -> bool:
+        """
+        删除 path 对应的索引，不存在时返回 False
+        """
+        i = self.find(path)
+        if i is None:
+            return False
+        self.cache_tree.invalidate(path)
+        for column in self.columns:
+            del column[i]
+        del self.sha1s[20 * i:20 * i + 20]
+        del self.flags[i]
+        del self.paths[i]
+        return True
+
+    def pack_entries(self, timestamp: Tuple[int, int] = None) -> bytes:
+        """
+        直接从各列生成 .git/index 中的索引数据，timestamp 见 Index.pack_entry
+        """
+        columns = self.columns
+        packed = []
+        for i, path in enumerate(self.paths):
+            packed.append(Index.pack_entry([column[i] for column in columns],
+                                           self.sha1s[20 * i:20 * i + 20], self.flags[i], path, timestamp))
+        return b''.join(packed)
+
+
+class SplitIndex:
+    """
+    git 的 split index：大部分索引保存在共享的 .git/sharedindex.<sha1> 中，
+    .git/index 只保存 link 扩展 [共享 index 的 sha1, 删除位图, 替换位图]、被替换的索引 (path 为空) 和新增的索引
+    两个位图均为 EWAH 格式，第 i 位表示共享 index 中的第 i 条索引
+    add 时只需改写很小的 .git/index，变动超过共享 index 的 SPLIT_INDEX_PERCENT% 时才合并写入新的共享 index
+    接口与 IndexTable 相同
+    """
+
+    def __init__(self, git_path: str, shared_sha1: str):
+        self.shared_sha1 = shared_sha1
+        self.shared = IndexView(os.path.join(git_path, f"sharedindex.{shared_sha1}"))
+        self.deleted = set()
+        self.replaced = {}
+        self.added = IndexTable()
+        self.cache_tree = CacheTree()
+        self.fsmonitor = None
+
+    @classmethod
+    def load(cls, git_path: str, view: IndexView, link: bytes) -> "SplitIndex":
+        split = cls(git_path, link[:20].hex())
+        deleted, pos = ewah_decode(link, 20)
+        replaced, _ = ewah_decode(link, pos)
+        split.deleted = set(iter_bits(deleted))
+        positions = list(iter_bits(replaced))
+        for i, pos in enumerate(positions):
+            split.replaced[pos] = split._with_path(view[i], split.shared.path_at(pos))
+        split.added = IndexTable.from_view(view, len(positions))
+        split.cache_tree = CacheTree.parse(view.extensions().get(b'TREE'))
+        return split
+
+    @staticmethod
+    def _with_path(entry: IndexEntry, path: str) -> IndexEntry:
+        flags = (entry.flags & ~0xfff) | min(len(path.encode()), 0xfff)
+        return entry._replace(flags=flags, path=path)
+
+    def __len__(self):
+        return len(self.shared) - len(self.deleted) + len(self.added)
+
+    def __iter__(self):
+        """
+        按 path 顺序合并共享 index 和新增的索引
+        """
+        def shared_entries():
+            for i in range(len(self.shared)):
+                if i not in self.deleted:
+                    yield self.replaced.get(i) or self.shared[i]
+        return heapq.merge(shared_entries(), self.added, key=lambda entry: entry.path.encode())
+
+    def iter_paths(self):
+        shared_paths = (self.shared.path_at(i) for i in range(len(self.shared)) if i not in self.deleted)
+        return heapq.merge(shared_paths, self.added.iter_paths(), key=str.encode)
+
+    def get(self, path: str) -> [IndexEntry, None]:
+        entry = self.added.get(path)
+        if entry is not None:
+            return entry
+        i = self.shared.find(path)
+        if i is None or i in self.deleted:
+            return None
+        return self.replaced.get(i) or self.shared[i]
+
+    def upsert(self, entry: IndexEntry) -> None:
+        old = self.get(entry.path)
+        if old is None or old.sha1 != entry.sha1 or old.mode != entry.mode:
+            self.cache_tree.invalidate(entry.path)
+        i = self.shared.find(entry.path)
+        if i is None:
+            self.added.upsert(entry)
+            return
+        self.deleted.discard(i)
+        self.replaced[i] = entry
+
+    def update(self, entries: List[IndexEntry]) -> None:
+        added = []
+        for entry in entries:
+            if self.shared.find(entry.path) is not None:
+                self.upsert(entry)
+                continue
+            old = self.added.get(entry.path)
+            if old is None or old.sha1 != entry.sha1 or old.mode != entry.mode:
+                self.cache_tree.invalidate(entry.path)
+            added.append(entry)
+        self.added.update(added)
+
+    def remove(self, path: str) -> bool:
+        if self.added.remove(path):
+            self.cache_tree.invalidate(path)
+            return True
+        i = self.shared.find(path)
+        if i is None or i in self.deleted:
+            return False
+        self.cache_tree.invalidate(path)
+        self.replaced.pop(i, None)
+        self.deleted.add(i)
+        return True
+
+    def changes(self) -> int:
+        return len(self.deleted) + len(self.replaced) + len(self.added)
+
+    def pack(self, timestamp: Tuple[int, int] = None) -> Tuple[int, bytes, bytes]:
+        """
+        生成 .git/index 中的内容，返回 (索引个数, 索引数据, link 扩展内容)，timestamp 见 Index.pack_entry
+        """
+        body = [Index.pack_entry(entry[:10], entry.sha1, entry.flags & ~0xfff, b'', timestamp)
+                for entry in (self.replaced[i] for i in sorted(self.replaced))]
+        body.append(self.added.pack_entries(timestamp))
+        deleted = sum(1 << i for i in self.deleted)
+        replaced = sum(1 << i for i in self.replaced)
+        link = bytes.fromhex(self.shared_sha1) + ewah_encode(deleted) + ewah_encode(replaced)
+        return len(self.replaced) + len(self.added), b''.join(body), link
+
+
 class Index:
     """
     管理 .git/index 文件
@@ -217,68 +2095,356 @@ class Index:
         else:
             self.git_path = find_path()
 
+    @staticmethod
+    def pack_entry(stat_fields, sha1: bytes, flags: int, path: bytes, timestamp: Tuple[int, int] = None) -> bytes:
+        """
+        打包一条索引：62 字节的头部 + path + NULL，按 8 字节对齐
+        stat 信息和 git 一样只保存低 32 位，4 GiB 以上的文件大小、64 位的 ino/dev 等都截断
+        timestamp 为新 index 的写入时间 (秒, 纳秒)，修改时间不早于它的索引和 git 的 ce_smudge_racily_clean_entry 一样
+        把 size 记为 0：之后 index 再次写入时修改时间变大，这些文件不能因此被 is_stat_clean 当作未修改
+        """
+        if timestamp and (stat_fields[2], stat_fields[3]) >= timestamp:
+            stat_fields = list(stat_fields)
+            stat_fields[9] = 0
+        # 62 字节的索引头部
+        entry_head = struct.pack('!LLLLLLLLLL20sH', *(field & 0xffffffff for field in stat_fields), sha1, flags)
+        # 对齐索引文件
+        length = ((62 + len(path) + 8) // 8) * 8
+        # 62 字节头部 + path + NULL
+        return entry_head + path + b'\x00' * (length - 62 - len(path))
+
     def write_index(self, entries):
         """
         将 entries 写入 .git/index 文件，这个 index 的生成规则和现有的 git 一样
         index 文件存储被 git 管理的文件索引，以 path 排序，每一行都包含 [path 名称, 修改时间, 文件 sha1 值] 等
         index 文件的前 12 个字节为头部[signature, version, entry length]，最后的 20 个字节为 index 索引文件的 sha1 值,
         中间的内容就是索引数据，索引属于以62个字节的头部+path和一些NULL组成，索引数据以 NULL 结尾
+        entries 为 IndexTable 时直接从各列生成索引数据；
+        entries 为 SplitIndex 且变动较少时只写入变动部分，否则合并为新的共享 index；
+        索引个数达到 SPLIT_INDEX_ENTRIES 时转为 split index
+        entries 带有 cache_tree 时写入 TREE 扩展，带有 fsmonitor 时写入 FSMN 扩展
+        修改时间落在当前这一秒及以后的索引按 racy-git 规则 smudge，见 pack_entry
         """
-        packed_entries = []
-        for entry in entries:
-            # 62 字节的索引头部
-            entry_head = struct.pack('!LLLLLLLLLL20sH',
-                                     entry.ctime_s, entry.ctime_n, entry.mtime_s, entry.mtime_n,
-                                     entry.dev, entry.ino, entry.mode, entry.uid, entry.gid,
-                                     entry.size, entry.sha1, entry.flags)
+        timestamp = (int(time.time()), 0)
+        cache_tree = getattr(entries, 'cache_tree', None)
+        extensions = {b'TREE': cache_tree.encode()} if cache_tree else {}
+        if getattr(entries, 'fsmonitor', None):
+            extensions[b'FSMN'] = self._encode_fsmonitor(entries)
+        if isinstance(entries, SplitIndex):
+            if entries.changes() * 100 <= SPLIT_INDEX_PERCENT * len(entries.shared):
+                count, body, link = entries.pack(timestamp)
+                self._write_file('index', count, body, {b'link': link, **extensions})
+                return
+        if not isinstance(entries, IndexTable):
+            entries = IndexTable.from_entries(entries)
+        if SPLIT_INDEX_ENTRIES and len(entries) >= SPLIT_INDEX_ENTRIES:
+            shared_sha1 = self._write_file(None, len(entries), entries.pack_entries(timestamp))
+            count, body, link = SplitIndex(self.git_path, shared_sha1).pack(timestamp)
+            self._write_file('index', count, body, {b'link': link, **extensions})
+            self._remove_shared(keep=shared_sha1)
+            return
+        self._write_file('index', len(entries), entries.pack_entries(timestamp), extensions)
+        self._remove_shared()
+
+    def _write_file(self, name: [str, None], count: int, body: bytes, extensions: dict = None) -> str:
+        """
+        写入 index 文件并返回其 sha1，name 为 None 时写入 sharedindex.<sha1>
+        先写入 .lock 文件再重命名，正在通过 mmap 读取旧 index 的 IndexView 不受影响；
+        .lock 已存在时说明其它进程正在写入，不覆盖其它进程的修改，直接报错
+        """
+        # 12 字节的 index 文件头部
+        header = struct.pack('!4sLL', b'DIRC', 2, count)
+        all_data = header + body + b''.join(
+            struct.pack('!4sL', signature, len(data)) + data for signature, data in (extensions or {}).items())
+        digest = hashlib.sha1(all_data).digest()
+        path = os.path.join(self.git_path, name or f"sharedindex.{digest.hex()}")
+        with lock_file(path) as f:
+            f.write(all_data + digest)
+        return digest.hex()
 
-            path = entry.path.encode()
+    def _remove_shared(self, keep: str = None) -> None:
+        """
+        删除不再使用的共享 index
+        """
+        for name in os.listdir(self.git_path):
+            if name.startswith("sharedindex.") and name != f"sharedindex.{keep}":
+                os.remove(os.path.join(self.git_path, name))
 
-            # 对齐索引文件
-            length = ((62 + len(path) + 8) // 8) * 8
-            # 62 字节头部 + path + NULL
-            packed_entry = entry_head + path + b'\x00' * (length - 62 - len(path))
-            packed_entries.append(packed_entry)
+    def view(self, verify: bool = False) -> [IndexView, SplitIndex]:
+        """
+        以 IndexView 的方式读取 .git/index 文件，索引在访问时才解析
+        .git/index 带有 link 扩展时返回合并了共享 index 的 SplitIndex
+        """
+        view = IndexView(os.path.join(self.git_path, 'index'), verify)
+        extensions = view.extensions() if view.data else {}
+        if extensions.get(b'link'):
+            view = SplitIndex.load(self.git_path, view, extensions[b'link'])
+        view.fsmonitor = self._decode_fsmonitor(extensions.get(b'FSMN'), view)
+        return view
+
+    def table(self) -> [IndexTable, SplitIndex]:
+        """
+        读取 .git/index 文件为可修改的 IndexTable，split index 时返回 SplitIndex
+        """
+        view = self.view(verify=True)
+        if isinstance(view, SplitIndex):
+            return view
+        table = IndexTable.from_view(view)
+        table.fsmonitor = view.fsmonitor
+        if view.data:
+            table.cache_tree = CacheTree.parse(view.extensions().get(b'TREE'))
+        return table
 
-        # 12 字节的 index 文件头部
-        header = struct.pack('!4sLL', b'DIRC', 2, len(entries))
-        all_data = header + b''.join(packed_entries)
-        digest = hashlib.sha1(all_data).digest()
-        write_file(os.path.join(self.git_path, 'index'), all_data + digest)
+    @staticmethod
+    def _decode_fsmonitor(data: [bytes, None], entries) -> [Tuple[str, Set[str]], None]:
+        """
+        解析 git 的 FSMN 扩展 [版本 2, token NULL, 位图长度, EWAH 位图]，
+        位图的第 i 位表示第 i 条索引在 token 之后可能有变动，返回 (token, 可能有变动的 path 集合)
+        """
+        if not data or struct.unpack_from('!L', data, 0)[0] != 2:
+            return None
+        end = data.index(b'\x00', 4)
+        bits, _ = ewah_decode(data, end + 5)
+        positions = set(iter_bits(bits))
+        dirty = {path for i, path in zip(range(max(positions, default=-1) + 1), entries.iter_paths())
+                 if i in positions}
+        return data[4:end].decode(), dirty
+
+    @staticmethod
+    def _encode_fsmonitor(entries) -> bytes:
+        token, dirty = entries.fsmonitor
+        bits = 0
+        if dirty:
+            for i, path in enumerate(entries.iter_paths()):
+                if path in dirty:
+                    bits |= 1 << i
+        bitmap = ewah_encode(bits)
+        return struct.pack('!L', 2) + token.encode() + b'\x00' + struct.pack('!L', len(bitmap)) + bitmap
 
     def read_index(self) -> List[IndexEntry]:
         """
         读取 .git/index 文件并返回 IndexEntry 对象列表
         """
+        return list(self.view(verify=True))
+
+    def get_mtime(self) -> Tuple[int, int]:
+        """
+        获取 .git/index 文件的修改时间 (秒, 纳秒)，index 不存在时返回 (0, 0)
+        """
+        tracing.count("fs.stat")
         try:
-            data = read_file(os.path.join(self.git_path, 'index'))
+            mtime_ns = os.stat(os.path.join(self.git_path, 'index')).st_mtime_ns
         except FileNotFoundError:
-            return []
-        # 校验文件是否被改动
-        digest = hashlib.sha1(data[:-20]).digest()
-        assert digest == data[-20:], 'index 文件非法'
+            return 0, 0
+        return divmod(mtime_ns, 1000000000)
 
-        # 获取 index 的头部
-        signature, version, num_entries = struct.unpack('!4sLL', data[:12])
-        assert signature == b'DIRC', f"签名不合法 {signature}"
+    @staticmethod
+    def is_stat_clean(entry: IndexEntry, st: os.stat_result, index_mtime: Tuple[int, int]) -> bool:
+        """
+        根据索引中记录的 stat 信息判断文件是否未被修改 (racy-git 规则)
+        ctime/mtime/size/ino/mode 全部一致时认为文件没有变化，size 和 ino 按索引中保存的低 32 位比较，
+        但若文件的修改时间不早于 index 的写入时间，则同一秒内可能发生过修改，仍需重新计算 sha1
+        """
+        mtime = divmod(st.st_mtime_ns, 1000000000)
+        if (entry.mtime_s, entry.mtime_n) != mtime:
+            return False
+        if (entry.ctime_s, entry.ctime_n) != divmod(st.st_ctime_ns, 1000000000):
+            return False
+        if entry.size != st.st_size & 0xffffffff or entry.ino != st.st_ino & 0xffffffff or entry.mode != st.st_mode:
+            return False
+        return mtime < index_mtime
 
-        assert version == 2, f"版本不合法 {version}"
 
-        # 解析 index 存储的对象索引
-        entry_data = data[12:-20]
-        entries = []
-        i = 0
-        while i + 62 < len(entry_data):
-            fields_end = i + 62
-            fields = struct.unpack('!LLLLLLLLLL20sH', entry_data[i:fields_end])
-            path_end = entry_data.index(b'\x00', fields_end)
-            path = entry_data[fields_end:path_end]
-            entry = IndexEntry(*(fields + (path.decode(),)))
-            entries.append(entry)
-            entry_len = ((62 + len(path) + 8) // 8) * 8
-            i += entry_len
-        assert len(entries) == num_entries
-        return entries
+class IgnoreFile:
+    """
+    编译后的一个 .gitignore 文件，规则按 git 的语义解析:
+        ! 开头表示取反，/ 结尾只匹配目录，
+        包含 / 的规则相对 .gitignore 所在目录匹配，否则匹配任意层级的文件名，
+        支持 * ? [...] 和 ** 通配符， " patten " 开头的行为匹配文件名的正则表达式
+    不含通配符的规则放入按文件名和路径查找的字典，其余规则合并为一个正则表达式，
+    后面的规则优先，因此倒序合并，第一个匹配的分组就是最后一条匹配的规则
+    """
+
+    def __init__(self, lines: List[str]):
+        self.negated = []
+        # 名称或路径 -> 规则序号，只匹配目录的规则单独保存
+        self.names, self.dir_names = {}, {}
+        self.paths, self.dir_paths = {}, {}
+        self.legacy = []
+        patterns = []
+        for line in lines:
+            if line.startswith(" patten "):
+                self.legacy.append((len(self.negated), re.compile(line[8:])))
+                self.negated.append(False)
+                continue
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            elif line.startswith('\\'):
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if not line:
+                continue
+            index = len(self.negated)
+            self.negated.append(negated)
+            if not any(c in line for c in '*?[\\'):
+                table = (self.dir_paths if dir_only else self.paths) if anchored else \
+                    (self.dir_names if dir_only else self.names)
+                table[line] = index
+                continue
+            regex = self.glob_regex(line)
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            patterns.append((index, dir_only, regex))
+        self.regex = self._compile([p for p in patterns if not p[1]])
+        self.dir_regex = self._compile(patterns)
+
+    @staticmethod
+    def _compile(patterns) -> [Tuple[re.Pattern, List[int]], None]:
+        """
+        倒序合并为一个正则表达式，返回 (正则表达式, 分组序号对应的规则序号)
+        """
+        if not patterns:
+            return None
+        groups = [0]
+        for index, _, regex in reversed(patterns):
+            groups.append(index)
+        return re.compile('|'.join(f'({regex})' for _, _, regex in reversed(patterns))), groups
+
+    @staticmethod
+    def glob_regex(pattern: str) -> str:
+        """
+        将 gitignore 的通配符转换为正则表达式，* ? 不匹配 /，** 匹配任意层级目录
+        """
+        result = []
+        i, n = 0, len(pattern)
+        while i < n:
+            if pattern.startswith('**/', i):
+                result.append('(?:.*/)?')
+                i += 3
+            elif pattern.startswith('**', i):
+                result.append('.*')
+                i += 2
+            elif pattern[i] == '*':
+                result.append('[^/]*')
+                i += 1
+            elif pattern[i] == '?':
+                result.append('[^/]')
+                i += 1
+            elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+                end = pattern.find(']', i + 2)
+                body = pattern[i + 1:end].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                result.append(f'[{body}]')
+                i = end + 1
+            elif pattern[i] == '\\' and i + 1 < n:
+                result.append(re.escape(pattern[i + 1]))
+                i += 2
+            else:
+                result.append(re.escape(pattern[i]))
+                i += 1
+        return ''.join(result)
+
+    def match(self, path: str, is_dir: bool) -> [bool, None]:
+        """
+        path 为相对 .gitignore 所在目录的路径，返回 True 表示忽略，False 表示被取反的规则排除，None 表示没有匹配
+        """
+        name = path.rpartition('/')[2]
+        best = max(self.names.get(name, -1), self.paths.get(path, -1))
+        if is_dir:
+            best = max(best, self.dir_names.get(name, -1), self.dir_paths.get(path, -1))
+        compiled = self.dir_regex if is_dir else self.regex
+        if compiled:
+            m = compiled[0].fullmatch(path)
+            if m:
+                best = max(best, compiled[1][m.lastindex])
+        for index, regex in self.legacy:
+            if index > best and regex.match(name):
+                best = index
+        return None if best < 0 else not self.negated[best]
+
+
+class Ignore:
+    """
+    工作目录的忽略规则，包括 .git/info/exclude 和各级目录中的 .gitignore
+    越深的 .gitignore 优先级越高，每个 .gitignore 只在修改后重新编译
+    """
+
+    # .gitignore 路径 -> (修改时间, 大小, IgnoreFile)，多次扫描工作目录时共用
+    _cache = {}
+
+    def __init__(self, work_path: str, git_path: str):
+        self.work_path = work_path
+        self.levels = {}
+        self.exclude = self._load(os.path.join(git_path, "info", "exclude"))
+
+    @classmethod
+    def _load(cls, path: str) -> [IgnoreFile, None]:
+        tracing.count("fs.stat")
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            cls._cache.pop(path, None)
+            return None
+        cached = cls._cache.get(path)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        ignore_file = IgnoreFile(read_file(path).decode().splitlines())
+        cls._cache[path] = (st.st_mtime_ns, st.st_size, ignore_file)
+        return ignore_file
+
+    def level(self, directory: str) -> [IgnoreFile, None]:
+        """
+        directory 目录中的 .gitignore，directory 为相对工作目录的路径
+        """
+        if directory not in self.levels:
+            self.levels[directory] = self._load(os.path.join(self.work_path, directory, ".gitignore"))
+        return self.levels[directory]
+
+    def is_ignored(self, path: str, is_dir: bool = False) -> bool:
+        """
+        path 为相对工作目录的路径，以 / 分隔
+        """
+        parts = path.split('/')
+        for depth in range(len(parts) - 1, -1, -1):
+            directory = '/'.join(parts[:depth])
+            ignore_file = self.level(directory)
+            if ignore_file:
+                result = ignore_file.match(path[len(directory) + 1:] if directory else path, is_dir)
+                if result is not None:
+                    return result
+        return bool(self.exclude and self.exclude.match(path, is_dir))
+
+    def is_path_ignored(self, path: str, is_dir: bool = False) -> bool:
+        """
+        和 is_ignored 相同，但上级目录被忽略时也返回 True，用于不经过目录遍历的单个文件
+        """
+        parts = path.split('/')
+        for depth in range(1, len(parts)):
+            if self.is_ignored('/'.join(parts[:depth]), True):
+                return True
+        return self.is_ignored(path, is_dir)
+
+    def walk(self, directory: str = '') -> Iterator[str]:
+        """
+        遍历 directory 中没有被忽略的文件，返回相对工作目录的路径，跳过 .git 和被忽略的目录
+        """
+        for root, dirs, files in os.walk(os.path.join(self.work_path, directory)):
+            tracing.count("fs.listdir")
+            prefix = os.path.relpath(root, self.work_path).replace(os.sep, '/') + '/'
+            if prefix == './':
+                prefix = ''
+            dirs[:] = [d for d in dirs if d != ".git" and not self.is_ignored(prefix + d, True)]
+            for file in files:
+                if not self.is_ignored(prefix + file):
+                    yield prefix + file
 
 
 class Status:
@@ -287,7 +2453,9 @@ class Status:
         对比文件的差异
     """
 
-    def __init__(self, git_path: str = ""):
+    UNTRACKED_FILE = "fsmonitor-untracked"
+
+    def __init__(self, git_path: str = "", workers: int = 0):
         if git_path:
             self.git_path = git_path
         else:
@@ -295,76 +2463,179 @@ class Status:
         self.work_path = os.path.realpath(os.path.join(self.git_path, ".."))
         self.index = Index(self.git_path)
         self.blob = Blob(self.git_path)
-        ignore_file_name = ".gitignore"
-        ignore_path = os.path.join(self.work_path, ignore_file_name)
-        self.ignore_pattern = set()
-        if os.path.exists(ignore_path):
-            self.ignore = set(read_file(ignore_path).decode().splitlines())
-            for ignore_item in self.ignore:
-                if ignore_item.startswith(" patten "):
-                    self.ignore_pattern.add(ignore_item[8:])
-            self.ignore.add(ignore_file_name)
-        else:
-            self.ignore = []
-        self.ignore -= self.ignore_pattern
+        self.engine = HashEngine(self.blob, workers)
+        self._index_mtime = None
+        self.ignore = Ignore(self.work_path, self.git_path)
+        # get_status 读取的 index，diff 时直接使用
+        self.view = None
 
     def get_status(self):
-        paths = set()
-        for root, dirs, files in os.walk(self.work_path):
-            tmp = []
-            for d in dirs:
-                if d == ".git":
-                    continue
-                if d in self.ignore:
-                    continue
-                flag = True
-                for p in self.ignore_pattern:
-                    if re.match(p, d):
-                        flag = False
-                        break
-                if not flag:
-                    continue
-                tmp.append(d)
+        """
+        返回 (内容改变的文件, 新增的文件, 删除的文件)
+        文件监控进程在运行且 index 中的 FSMN token 有效时，只检查 token 之后变动的文件、
+        上次检查时 stat 信息不一致的文件和上次的新增文件，否则遍历整个工作目录；
+        之后将新的 token 写入 index，新增的文件写入 .git/fsmonitor-untracked
+        """
+        with tracing.Span("status.read_index"):
+            view = self.view = self.index.view()
+        state = view.fsmonitor
+        with tracing.Span("status.fsmonitor_query"):
+            result = fsmonitor.query(self.git_path, state[0] if state else "")
+        untracked = None
+        if state and result and result[1] is not None and \
+                not any(path.rpartition('/')[2] == ".gitignore" for path in result[1]):
+            untracked = self._read_untracked(state[0])
+        if untracked is None:
+            changed, new, deleted, dirty = self._scan(view)
+        else:
+            changed, new, deleted, dirty = self._scan_paths(view, state[1] | result[1] | untracked)
+        if result and (not state or state[0] != result[0] or state[1] != dirty):
+            # 和 git 自动刷新 index 一样，index.lock 被其它进程持有时跳过这次写入，下次 status 再更新 token
+            try:
+                table = self.index.table()
+                table.fsmonitor = (result[0], dirty)
+                self.index.write_index(table)
+            except FileExistsError:
+                pass
+            else:
+                tracing.count("status.index_rewrites")
+                write_file(os.path.join(self.git_path, self.UNTRACKED_FILE),
+                           '\n'.join([result[0]] + sorted(new)).encode())
+        return sorted(changed), sorted(new), sorted(deleted)
 
-            dirs[:] = tmp
-            for file in files:
-                if file in self.ignore:
-                    continue
-                flag = True
-                for p in self.ignore_pattern:
-                    if re.match(p, file):
-                        flag = False
-                        break
-                if not flag:
-                    continue
-                path = file.replace('\\', '/')
-                if path.startswith('./'):
-                    path = path[2:]
-                paths.add(path)
-        entries_by_path = {e.path: e for e in self.index.read_index()}
+    def _scan(self, view) -> Tuple[Set[str], Set[str], Set[str], Set[str]]:
+        """
+        遍历整个工作目录，返回 (内容改变的文件, 新增的文件, 删除的文件, stat 信息和索引不一致的文件)
+        """
+        with tracing.Span("status.walk"):
+            paths = set(self.ignore.walk())
+        entries_by_path = {e.path: e for e in view}
         entry_paths = set(entries_by_path)
-        changed = {p for p in (paths & entry_paths) if self.blob.compress(p) != entries_by_path[p].sha1.hex()}
-        new = paths - entry_paths
+        # stat 信息未变的文件直接信任索引，其余文件交给 HashEngine 并行计算 sha1
+        with tracing.Span("status.stat"):
+            dirty = [p for p in sorted(paths & entry_paths) if not self.is_stat_clean(p, entries_by_path[p])]
+        with tracing.Span("status.hash"):
+            sha1s = self.engine.hash([os.path.join(self.work_path, p) for p in dirty])
+        changed = {p for p, sha1 in zip(dirty, sha1s) if sha1 != entries_by_path[p].sha1.hex()}
         deleted = entry_paths - paths
-        return sorted(changed), sorted(new), sorted(deleted)
+        return changed, self._hide_gitignore(paths - entry_paths), deleted, set(dirty) | deleted
+
+    def _scan_paths(self, view, paths: Set[str]) -> Tuple[Set[str], Set[str], Set[str], Set[str]]:
+        """
+        只检查 paths 中的文件，返回值和 _scan 相同
+        """
+        new, deleted, dirty = set(), set(), []
+        entries_by_path = {}
+        for path in paths:
+            entry = view.get(path)
+            full_path = os.path.join(self.work_path, path)
+            tracing.count("fs.stat")
+            exists = os.path.isfile(full_path)
+            if entry is None:
+                if exists and not self.ignore.is_path_ignored(path):
+                    new.add(path)
+            elif not exists:
+                deleted.add(path)
+            elif not self.is_stat_clean(path, entry):
+                entries_by_path[path] = entry
+                dirty.append(path)
+        with tracing.Span("status.hash"):
+            sha1s = self.engine.hash([os.path.join(self.work_path, p) for p in dirty])
+        changed = {p for p, sha1 in zip(dirty, sha1s) if sha1 != entries_by_path[p].sha1.hex()}
+        return changed, self._hide_gitignore(new), deleted, set(dirty) | deleted
+
+    @staticmethod
+    def _hide_gitignore(new: Set[str]) -> Set[str]:
+        """
+        新增的文件中不显示 .gitignore，已在索引中的 .gitignore 和其它文件一样比较
+        """
+        return {path for path in new if path.rpartition('/')[2] != ".gitignore"}
 
-    def diff(self):
+    def _read_untracked(self, token: str) -> [Set[str], None]:
+        """
+        读取上次 status 记录的新增文件，token 和 index 中的不一致时返回 None
+        """
+        try:
+            lines = read_file(os.path.join(self.git_path, self.UNTRACKED_FILE)).decode().split('\n')
+        except FileNotFoundError:
+            return None
+        return set(lines[1:]) - {''} if lines[0] == token else None
+
+    def is_stat_clean(self, path: str, entry: IndexEntry) -> bool:
+        """
+        判断文件的 stat 信息是否和索引一致，一致时无需重新计算 sha1
+        """
+        if self._index_mtime is None:
+            self._index_mtime = self.index.get_mtime()
+        tracing.count("fs.stat")
+        return self.index.is_stat_clean(entry, os.stat(os.path.join(self.work_path, path)), self._index_mtime)
+
+    def diff(self, context: int = 3, out=None):
+        """
+        将索引和工作目录中内容不同的文件以 unified diff 的格式写入 out，默认为标准输出
+        直接使用 get_status 读取的 index，多个文件时在进程池中并行解压和计算 diff，按 path 顺序输出
+        diff 分块写入 out，不在内存中拼接整个文件的 diff；进程池中的 diff 分块写入临时文件，按顺序复制到 out 后删除
+        """
+        out = out or sys.stdout.buffer
         changed, _, _ = self.get_status()
-        entries_by_path = {e.path: e for e in self.index.read_index()}
-        for i, path in enumerate(changed):
-            sha1 = entries_by_path[path].sha1.hex()
-            data = self.blob.decompress(sha1)
-            index_lines = data.decode().splitlines()
-            working_lines = read_file(path).decode().splitlines()
-            diff_lines = difflib.unified_diff(
-                index_lines, working_lines,
-                '{} (index)'.format(path),
-                '{} (working copy)'.format(path),
-                lineterm='')
-            for line in diff_lines:
-                print(line)
-            if i < len(changed) - 1:
-                print('-' * 70)
+        tasks = [(self.git_path, self.work_path, path, self.view.get(path).sha1.hex(), context) for path in changed]
+        pool, futures = None, []
+        if len(tasks) > 1 and self.engine.workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(min(self.engine.workers, len(tasks)),
+                                       initializer=tracing.init_worker, initargs=(tracing.ENABLED,))
+            futures = [pool.submit(diff_file_to_temp, task) for task in tasks]
+        try:
+            for i, task in enumerate(tasks):
+                if pool:
+                    tmp_path, counters = futures[i].result()
+                    tracing.merge_counters(counters)
+                    with open(tmp_path, "rb") as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            out.write(chunk)
+                    os.remove(tmp_path)
+                else:
+                    for chunk in diff_file(task):
+                        out.write(chunk)
+                if i < len(tasks) - 1:
+                    out.write(b'-' * 70 + b'\n')
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+                # 中途退出时删除已经生成但没有输出的临时文件
+                for future in futures:
+                    if future.done() and not future.cancelled() and future.exception() is None \
+                            and os.path.exists(future.result()[0]):
+                        os.remove(future.result()[0])
+        out.flush()
+
+
+def diff_file(task: Tuple[str, str, str, str, int]) -> Iterator[bytes]:
+    """
+    分块生成一个文件的索引内容和工作目录内容的 unified diff
+    task 为 (git 目录, 工作目录, path, 索引中的 sha1, 上下文行数)
+    """
+    git_path, work_path, path, sha1, context = task
+    data = Blob(git_path).decompress(sha1)
+    working_data = read_file(os.path.join(work_path, path))
+    yield from xdiff.unified_diff(
+        data, working_data,
+        '{} (index)'.format(path),
+        '{} (working copy)'.format(path),
+        context)
+
+
+def diff_file_to_temp(task: Tuple[str, str, str, str, int]) -> Tuple[str, dict]:
+    """
+    在 Status.diff 的进程池中执行，将 diff_file 的分块写入 .git 下的临时文件，
+    返回 (临时文件路径, 本次任务的 tracing 计数)，计数由父进程合并
+    """
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp_diff_", dir=task[0])
+    with os.fdopen(fd, "wb") as f:
+        for chunk in diff_file(task):
+            f.write(chunk)
+    return tmp_path, tracing.take_counters()
 
 
 class Mixin(HashObject):
@@ -372,30 +2643,20 @@ class Mixin(HashObject):
         "commit": 1,
         "tree": 2,
         "blob": 3,
+        "tag": 4,
     }
 
     def decompress(self, sha1: str) -> Tuple[str, bytes]:
         """
-        解析 blob 数据
+        解析任意类型的对象数据
         """
-        path = self.find_object(sha1)
-        full_data = zlib.decompress(read_file(path))
-
-        nul_index = full_data.index(b'\x00')
-        header = full_data[:nul_index]
-
-        obj_type, size_str = header.decode().split()
-        size = int(size_str)
-        data = full_data[nul_index + 1:]
-
-        assert size == len(data), f"数据长度应为 {size}, 得到 {len(data)} bytes"
-
-        return obj_type, data
+        return self.read_object(sha1)
 
-    def encode_pack_object(self, obj):
-        obj_type, data = self.decompress(obj)
-        type_num = self.OBJ_TYPE[obj_type]
-        size = len(data)
+    @staticmethod
+    def encode_pack_header(type_num: int, size: int) -> bytes:
+        """
+        编码 pack 中对象的头部，第一个字节的 4-6 位为类型，其余为变长的长度
+        """
         byte = (type_num << 4) | (size & 0x0f)
         size >>= 4
         header = []
@@ -404,17 +2665,282 @@ class Mixin(HashObject):
             byte = size & 0x7f
             size >>= 7
         header.append(byte)
-        return bytes(header) + zlib.compress(data)
-
-    def create_pack(self, objects):
-        header = struct.pack('!4sLL', b'PACK', 2, len(objects))
-        body = b''.join(self.encode_pack_object(o) for o in sorted(objects))
-        contents = header + body
-        sha1 = hashlib.sha1(contents).digest()
-        data = contents + sha1
-        return data
+        return bytes(header)
+
+    @staticmethod
+    def encode_ofs(distance: int) -> bytes:
+        """
+        编码 OFS_DELTA 中 base 对象的相对距离，与 Pack._read_ofs 对应
+        """
+        result = [distance & 0x7f]
+        distance >>= 7
+        while distance:
+            distance -= 1
+            result.append(0x80 | (distance & 0x7f))
+            distance >>= 7
+        return bytes(reversed(result))
+
+    def encode_pack_object(self, obj):
+        obj_type, data = self.decompress(obj)
+        return self.encode_pack_header(self.OBJ_TYPE[obj_type], len(data)) + zlib.compress(data)
+
+    def iter_pack(self, objects, bases: dict = None, ofs_delta: bool = True, window: int = 10, depth: int = 50):
+        """
+        以生成器的方式逐个输出 push 使用的 pack 数据块，末尾的 sha1 边输出边计算，
+        内存中只保留 delta 窗口内的对象，与 pack 的总大小无关
+        objects 为 {sha1: 路径名或路径名 hash} 时按路径名寻找相似对象；
+        bases 为接收方已有的 {路径名: sha1}，同路径的对象会尝试以 REF_DELTA 引用它们，生成 thin pack；
+        ofs_delta 为 False 时 pack 内部的 delta 也使用 REF_DELTA
+        """
+        names = objects if isinstance(objects, dict) else dict.fromkeys(objects, '')
+        header = struct.pack('!4sLL', b'PACK', 2, len(names))
+        digest = hashlib.sha1(header)
+        yield header
+        for _, entry in self.iter_pack_entries(self.sort_for_delta(names), window, depth, names, bases, ofs_delta):
+            digest.update(entry)
+            yield entry
+        yield digest.digest()
+
+    def create_pack(self, objects, bases: dict = None, ofs_delta: bool = True, window: int = 10, depth: int = 50):
+        """
+        将对象打包为完整的 pack 数据，参数同 iter_pack
+        """
+        return b''.join(self.iter_pack(objects, bases, ofs_delta, window, depth))
+
+    @staticmethod
+    def name_hash(name: [str, int]) -> int:
+        """
+        路径名的 hash，name 已经是 hash (来自 bitmap) 时直接返回
+        """
+        return name if isinstance(name, int) else pack_name_hash(name)
 
+    def sort_for_delta(self, names: dict) -> List[str]:
+        """
+        按 (类型, 路径名 hash, 长度降序) 排序，使可能相似的对象相邻
+        """
+        infos = {sha1: self.read_info(sha1) for sha1 in names}
+        return sorted(names, key=lambda sha1: (infos[sha1][0], self.name_hash(names[sha1]), -infos[sha1][1], sha1))
+
+    def iter_pack_entries(self, objects: List[str], window: int = 10, depth: int = 50,
+                          names: dict = None, bases: dict = None, ofs_delta: bool = True):
+        """
+        按顺序编码对象，生成 (sha1, pack 中的对象数据)
+        每个对象在前 window 个同类型对象中选择 delta 最小的作为 base，
+        若 bases 中有路径名 hash 相同的对象也一并尝试，delta 小于原数据一半时写为 delta，delta 链长度不超过 depth
+        超过 BIG_FILE_THRESHOLD 的对象不计算 delta 也不放入窗口，窗口中对象的总大小不超过 DELTA_WINDOW_MEMORY
+        base 在 pack 中时写为 OFS_DELTA (ofs_delta 为 False 时写为 REF_DELTA)，base 在 bases 中时写为 REF_DELTA
+        """
+        offsets = {}
+        offset = 12
+        recent = collections.deque()
+        window_bytes = 0
+        bases = {self.name_hash(name): sha1 for name, sha1 in bases.items()} if bases and names else {}
+        for sha1 in objects:
+            obj_type, data = self.decompress(sha1)
+            max_size = len(data) // 2 - 20 if len(data) <= BIG_FILE_THRESHOLD else 0
+            candidates = list(recent)
+            base_sha1 = bases.get(self.name_hash(names[sha1])) if bases and max_size > 0 else None
+            if base_sha1 and base_sha1 != sha1:
+                base_type, base_data = self.decompress(base_sha1)
+                candidates.insert(0, (base_sha1, base_type, base_data, 0))
+            best, best_depth = None, 0
+            for base_sha1, base_type, base_data, base_depth in (candidates if max_size > 0 else ()):
+                if base_type != obj_type or base_depth >= depth or len(base_data) < len(data) // 32:
+                    continue
+                delta = create_delta(base_data, data, len(best[1]) - 1 if best else max_size)
+                if delta is not None:
+                    best, best_depth = (base_sha1, delta), base_depth + 1
+            if not best:
+                entry = self.encode_pack_header(self.OBJ_TYPE[obj_type], len(data)) + zlib.compress(data)
+            elif ofs_delta and best[0] in offsets:
+                base_sha1, delta = best
+                entry = (self.encode_pack_header(Pack.OFS_DELTA, len(delta)) +
+                         self.encode_ofs(offset - offsets[base_sha1]) + zlib.compress(delta))
+            else:
+                base_sha1, delta = best
+                entry = (self.encode_pack_header(Pack.REF_DELTA, len(delta)) +
+                         bytes.fromhex(base_sha1) + zlib.compress(delta))
+            offsets[sha1] = offset
+            offset += len(entry)
+            tracing.count("pack.objects")
+            tracing.count("pack.deltas" if best else "pack.full_objects")
+            tracing.count("pack.bytes", len(entry))
+            if window and len(data) <= BIG_FILE_THRESHOLD:
+                recent.append((sha1, obj_type, data, best_depth))
+                window_bytes += len(data)
+                while len(recent) > window or (window_bytes > DELTA_WINDOW_MEMORY and len(recent) > 1):
+                    window_bytes -= len(recent.popleft()[2])
+            yield sha1, entry
+
+    def write_pack(self, names: dict, window: int = 10, depth: int = 50) -> str:
+        """
+        将 names 中的对象打包写入 .git/objects/pack/pack-<sha1>.pack，并生成对应的 idx 文件
+        返回 pack 的 sha1
+        """
+        objects = self.iter_pack_entries(self.sort_for_delta(names), window, depth, names)
+        return self.write_pack_file(objects, len(names))
+
+    def write_pack_file(self, objects: Iterator[Tuple[str, bytes]], count: int = None) -> [str, None]:
+        """
+        将 (sha1, pack 中的对象数据) 依次写入 .git/objects/pack 下的临时 pack，重命名为 pack-<sha1>.pack 后生成 idx，
+        idx 最后写入，保证读取时 pack 总是完整的
+        count 为对象个数，写入时同时计算 pack 的 sha1；count 为 None 时结束后回写对象个数，再重新读取计算 sha1
+        返回 pack 的 sha1，没有对象时不生成 pack，返回 None
+        """
+        pack_dir = os.path.join(self.objs_path, "pack")
+        os.makedirs(pack_dir, exist_ok=True)
+        entries = []
+        with temp_file(pack_dir, "tmp_pack_") as f:
+            header = struct.pack('!4sLL', b'PACK', 2, count or 0)
+            f.write(header)
+            digest = hashlib.sha1(header) if count is not None else None
+            offset = len(header)
+            for sha1, entry in objects:
+                f.write(entry)
+                if digest:
+                    digest.update(entry)
+                entries.append((sha1, zlib.crc32(entry), offset))
+                offset += len(entry)
+            if not entries:
+                return None
+            if digest is None:
+                f.seek(0)
+                f.write(struct.pack('!4sLL', b'PACK', 2, len(entries)))
+                f.seek(0)
+                digest = hashlib.sha1()
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            pack_sha1 = digest.digest()
+            f.write(pack_sha1)
+            pack_path = os.path.join(pack_dir, f"pack-{pack_sha1.hex()}")
+            f.target = pack_path + ".pack"
+        self.write_pack_index(pack_path + ".idx", entries, pack_sha1)
+        self._packs = None
+        return pack_sha1.hex()
+
+    @staticmethod
+    def write_pack_index(path: str, entries: List[Tuple[str, int, int]], pack_sha1: bytes) -> None:
+        """
+        根据 [(sha1, crc32, offset)] 生成 version 2 的 idx 文件，格式见 PackIndex
+        """
+        entries = sorted(entries)
+        fanout = [0] * 256
+        for sha1, _, _ in entries:
+            fanout[int(sha1[:2], 16)] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        offsets, large_offsets = [], []
+        for _, _, offset in entries:
+            if offset < 0x80000000:
+                offsets.append(offset)
+            else:
+                offsets.append(0x80000000 | len(large_offsets))
+                large_offsets.append(offset)
+        data = b''.join([
+            PackIndex.SIGNATURE, struct.pack('!L', 2), struct.pack('!256L', *fanout),
+            b''.join(bytes.fromhex(sha1) for sha1, _, _ in entries),
+            b''.join(struct.pack('!L', crc) for _, crc, _ in entries),
+            b''.join(struct.pack('!L', offset) for offset in offsets),
+            b''.join(struct.pack('!Q', offset) for offset in large_offsets),
+            pack_sha1,
+        ])
+        with lock_file(path) as f:
+            f.write(data + hashlib.sha1(data).digest())
+
+    def prune_packed(self, pack_sha1: str) -> int:
+        """
+        删除已经存在于 pack-<pack_sha1> 中的松散对象，以及对象全部包含在其中的旧 pack
+        返回删除的松散对象个数
+        """
+        pack_dir = os.path.join(self.objs_path, "pack")
+        name = f"pack-{pack_sha1}"
+        packed = set(PackIndex(os.path.join(pack_dir, name + ".idx")).sha1s())
+        pruned = 0
+        for sha1 in packed:
+            path = os.path.join(self.objs_path, sha1[:2], sha1[2:])
+            if os.path.exists(path):
+                os.remove(path)
+                pruned += 1
+        for fan_out in os.listdir(self.objs_path):
+            path = os.path.join(self.objs_path, fan_out)
+            if len(fan_out) == 2 and os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
+        for idx_name in os.listdir(pack_dir):
+            old_name = idx_name[:-len(".idx")]
+            if not idx_name.endswith(".idx") or old_name == name:
+                continue
+            if os.path.exists(os.path.join(pack_dir, old_name + ".keep")):
+                continue
+            if set(PackIndex(os.path.join(pack_dir, idx_name)).sha1s()) <= packed:
+                os.remove(os.path.join(pack_dir, idx_name))
+                for suffix in (".pack", ".bitmap", ".rev"):
+                    if os.path.exists(os.path.join(pack_dir, old_name + suffix)):
+                        os.remove(os.path.join(pack_dir, old_name + suffix))
+        self._packs = None
+        return pruned
+
+
+class BulkCheckin(Mixin):
+    """
+    批量添加文件时将新的 blob 写入同一个 pack，不再为每个文件创建目录和松散对象
+    文件在线程池中读取、计算 sha1 并压缩为 pack 中的对象数据，主线程按输入顺序写入临时 pack，
+    同时处理的文件不超过 workers * 2 个，内存占用和文件个数无关
+    已存在的对象和重复的内容不再写入，超过 BULK_CHECKIN_MAX_SIZE 的文件仍流式写为松散对象
+    对象个数在结束时回写到 pack 头部，再计算 pack 的 sha1 并生成 idx；多次添加产生的 pack 由 gc 合并
+    """
+
+    def __init__(self, git_path: str = "", workers: int = 0):
+        super().__init__(git_path)
+        self.workers = workers or HASH_WORKERS
+        self.blob = Blob(self.git_path)
+
+    def _encode(self, path: str) -> Tuple[str, [bytes, None]]:
+        """
+        返回 (sha1, pack 中的对象数据)，对象已存在或写为松散对象时对象数据为 None
+        """
+        tracing.count("fs.stat")
+        if os.path.getsize(path) > BULK_CHECKIN_MAX_SIZE:
+            return self.blob.compress(path), None
+        data = read_file(path)
+        sha1 = hashlib.sha1(self._build_head(Blob.TYPE, len(data)) + data).hexdigest()
+        tracing.count("objects.hashed")
+        if self.has_object(sha1):
+            return sha1, None
+        tracing.count("zlib.bytes_deflated", len(data))
+        return sha1, self.encode_pack_header(self.OBJ_TYPE[Blob.TYPE], len(data)) + zlib.compress(data)
+
+    def _iter_encoded(self, paths: List[str]) -> Iterator[Tuple[str, [bytes, None]]]:
+        if self.workers <= 1 or len(paths) <= 1:
+            yield from map(self._encode, paths)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            for path in paths:
+                pending.append(executor.submit(self._encode, path))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def checkin(self, paths: List[str]) -> List[str]:
+        """
+        写入 paths 中的文件，按输入顺序返回 sha1，没有新对象时不生成 pack
+        """
+        sha1s, written = [], set()
+
+        def new_objects():
+            for sha1, entry in self._iter_encoded(paths):
+                sha1s.append(sha1)
+                if entry is None or sha1 in written:
+                    continue
+                written.add(sha1)
+                tracing.count("objects.written")
+                tracing.count("pack.bytes", len(entry))
+                yield sha1, entry
 
+        self.write_pack_file(new_objects())
+        return sha1s
 
 
 if __name__ == '__main__':
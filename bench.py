@@ -0,0 +1,274 @@
+"""
+性能测试：生成模拟的仓库，统计各个命令的耗时、吞吐量和内存峰值，以 JSON 格式输出
+    仓库的文件数、文件大小、目录深度、提交次数和每次提交修改的文件比例均可配置，
+    push 发送到本地模拟的 receive-pack 服务，只统计数据不解析 pack
+    startup_* 阶段在新的进程中多次执行 z 命令，记录包含解释器启动和导入模块在内的耗时中位数
+    指定 --baseline 时和之前的结果对比，耗时增加超过 --threshold 的阶段记为性能退化，并以状态码 1 退出
+    python bench.py --files 2000 --size 4096 --depth 3 --history 20 --churn 0.05 --output result.json
+"""
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+
+import api
+import lib
+from base import Commit, Mixin, Tree
+
+AUTHOR = "bench <bench@example.com>"
+# 每层目录的子目录个数
+FANOUT = 8
+# 命令行入口
+ENTRY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "z")
+
+
+def pkt_line(data: bytes) -> bytes:
+    return b'%04x' % (len(data) + 4) + data
+
+
+class ReceivePackHandler(BaseHTTPRequestHandler):
+    """
+    模拟 git 服务器的 receive-pack 接口，记录 master 的 sha1 和收到的数据量
+    """
+
+    protocol_version = "HTTP/1.1"
+    master = None
+    received = 0
+
+    def _reply(self, body: bytes) -> None:
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_GET(self):
+        sha1 = (ReceivePackHandler.master or '0' * 40).encode()
+        ref = b'refs/heads/master' if ReceivePackHandler.master else b'capabilities^{}'
+        self._reply(pkt_line(b'# service=git-receive-pack\n') + b'0000' +
+                    pkt_line(sha1 + b' ' + ref + b'\x00report-status side-band-64k ofs-delta\n') + b'0000')
+
+    def do_POST(self):
+        body = self._read_body()
+        ReceivePackHandler.received += len(body)
+        _, new_sha1, rest = body[4:int(body[:4], 16)].split(b' ', 2)
+        ReceivePackHandler.master = new_sha1.decode()
+        report = pkt_line(b'unpack ok\n') + pkt_line(b'ok refs/heads/master\n') + b'0000'
+        if b'side-band-64k' in rest.partition(b'\x00')[2].split():
+            report = pkt_line(b'\x01' + report) + b'0000'
+        self._reply(report)
+
+    def log_message(self, *args):
+        pass
+
+
+def peak_rss_kb() -> int:
+    """
+    进程启动以来的内存峰值 (ru_maxrss)，只增不减，不是某个阶段自己的峰值
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def time_command(args, runs: int):
+    """
+    在新的进程中执行 runs 次 z 命令，返回每次的耗时
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, ENTRY] + args, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def file_path(i: int, depth: int) -> str:
+    dirs = [f"d{(i // FANOUT ** (depth - level)) % FANOUT}" for level in range(depth)]
+    return '/'.join(dirs + [f"f{i}.txt"])
+
+
+def file_content(rng: random.Random, size: int) -> bytes:
+    data = rng.randbytes(size // 2 + 1).hex()[:size]
+    return '\n'.join(data[i:i + 63] for i in range(0, len(data), 63)).encode() + b'\n'
+
+
+def generate(work_path: str, files: int, size: int, depth: int, rng: random.Random):
+    """
+    在 work_path 中生成 files 个文件，返回相对路径列表
+    """
+    paths = [file_path(i, depth) for i in range(files)]
+    for path in paths:
+        full_path = os.path.join(work_path, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        lib.write_file(full_path, file_content(rng, size))
+    return paths
+
+
+def mutate(paths, churn: float, size: int, rng: random.Random):
+    """
+    修改 churn 比例的文件中的一段内容，返回被修改的文件
+    """
+    changed = sorted(rng.sample(paths, max(1, int(len(paths) * churn))))
+    for path in changed:
+        lines = lib.read_file(path).split(b'\n')
+        start = rng.randrange(len(lines))
+        lines[start:start + 4] = file_content(rng, 256).split(b'\n')
+        lib.write_file(path, b'\n'.join(lines))
+    return changed
+
+
+class Bench:
+    """
+    依次执行各个阶段，每个阶段记录耗时、吞吐量和内存：
+        process_peak_rss_kb 为阶段结束时整个进程累计的内存峰值，
+        peak_rss_growth_kb 为本阶段使进程峰值增加的部分，为 0 表示本阶段没有超过之前阶段的峰值
+    """
+
+    def __init__(self):
+        self.results = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str, amount: float = 0, unit: str = ""):
+        start_rss = peak_rss_kb()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            result = {}
+            yield result
+            seconds = time.perf_counter() - start
+        end_rss = peak_rss_kb()
+        result.update(seconds=round(seconds, 6), process_peak_rss_kb=end_rss, peak_rss_growth_kb=end_rss - start_rss)
+        amount = result.pop("amount", amount)
+        if amount and unit:
+            result["throughput"] = round(amount / seconds, 3) if seconds else None
+            result["unit"] = unit
+        self.results[name] = result
+
+
+def run(files: int, size: int, depth: int, history: int, churn: float, seed: int, workers: int,
+        startup_runs: int = 10) -> dict:
+    rng = random.Random(seed)
+    root = tempfile.mkdtemp(prefix="g-bench-")
+    cwd = os.getcwd()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ReceivePackHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    bench = Bench()
+    try:
+        os.chdir(root)
+        paths = generate(root, files, size, depth, rng)
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+
+        with bench.phase("init"):
+            api.init()
+        with bench.phase("add", total_bytes / 1e6, "MB/s") as result:
+            api.add(paths, workers)
+            result["files"] = len(paths)
+        with bench.phase("commit"):
+            base_sha1 = api.commit("initial", AUTHOR)
+        with bench.phase("status_clean", len(paths), "files/s"):
+            api.status(workers)
+        for name, args in (("startup_help", ["--help"]), ("startup_status", ["status"])):
+            with bench.phase(name, startup_runs, "runs/s") as result:
+                times = sorted(time_command(args, startup_runs))
+                result["median_ms"] = round(times[len(times) // 2] * 1000, 3)
+
+        with bench.phase("history", history, "commits/s"):
+            for i in range(history):
+                api.add(mutate(paths, churn, size, rng), workers)
+                api.commit(f"commit {i}", AUTHOR)
+
+        changed = mutate(paths, churn, size, rng)
+        with bench.phase("status_dirty", len(paths), "files/s") as result:
+            api.status(workers)
+            result["changed"] = len(changed)
+        with bench.phase("diff", len(changed), "files/s"):
+            api.diff(workers)
+
+        commit_obj = Commit(os.path.join(root, ".git"))
+        local_sha1 = commit_obj.get_local_master_hash()
+        with bench.phase("find_missing_objects", unit="objects/s") as result:
+            missing = commit_obj.find_missing_objects(local_sha1, base_sha1)
+            result["amount"] = result["objects"] = len(missing)
+        mixin_obj = Mixin(commit_obj.git_path)
+        bases = commit_obj.find_edge_objects(base_sha1, Tree(commit_obj.git_path))
+        with bench.phase("create_pack", len(missing), "objects/s") as result:
+            result["bytes"] = len(mixin_obj.create_pack(missing, bases))
+
+        ReceivePackHandler.master = base_sha1
+        ReceivePackHandler.received = 0
+        lib.G_GITHUB_REPO = f"http://127.0.0.1:{server.server_port}/bench.git"
+        with bench.phase("push", len(missing), "objects/s") as result:
+            api.push()
+            result["bytes"] = ReceivePackHandler.received
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        "config": dict(files=files, size=size, depth=depth, history=history, churn=churn, seed=seed,
+                       workers=workers or lib.HASH_WORKERS, startup_runs=startup_runs,
+                       python=sys.version.split()[0]),
+        "results": bench.results,
+        "process_peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def find_regressions(report: dict, baseline: dict, threshold: float):
+    """
+    对比各阶段的耗时，返回比 baseline 慢 threshold 以上的阶段
+    """
+    regressions = []
+    for name, result in report["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if old and old["seconds"] > 0 and result["seconds"] > old["seconds"] * (1 + threshold):
+            regressions.append({"phase": name, "baseline": old["seconds"], "seconds": result["seconds"],
+                                "ratio": round(result["seconds"] / old["seconds"], 3)})
+    return regressions
+
+
+@click.command(help="生成模拟仓库并统计各命令的性能")
+@click.option("--files", default=1000, help="文件个数")
+@click.option("--size", default=4096, help="每个文件的字节数")
+@click.option("--depth", default=2, help="目录深度")
+@click.option("--history", default=10, help="提交次数")
+@click.option("--churn", default=0.02, help="每次提交修改的文件比例")
+@click.option("--seed", default=0, help="随机数种子")
+@click.option("-j", "--jobs", default=0, help="并行的线程数，默认为 cpu 核数")
+@click.option("--startup-runs", default=10, help="测量启动耗时时每个命令的执行次数")
+@click.option("--baseline", type=click.Path(exists=True), help="对比的上一次结果")
+@click.option("--threshold", default=0.2, help="耗时增加超过该比例时记为性能退化")
+@click.option("--output", type=click.Path(), help="结果写入的文件，默认输出到标准输出")
+def main(files, size, depth, history, churn, seed, jobs, startup_runs, baseline, threshold, output):
+    report = run(files, size, depth, history, churn, seed, jobs, startup_runs)
+    if baseline:
+        with open(baseline) as f:
+            report["regressions"] = find_regressions(report, json.load(f), threshold)
+    data = json.dumps(report, indent=2)
+    if output:
+        lib.write_file(output, data.encode())
+    else:
+        click.echo(data)
+    sys.exit(1 if report.get("regressions") else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+基于 Linux inotify 的工作目录监控进程
+监控进程记录工作目录中每个文件最后一次变动的序号，status 通过 .git/fsmonitor.sock 查询某个 token 之后变动的文件，
+只检查这些文件而不用遍历整个工作目录
+token 为 "进程标识:序号"，监控进程重启或 inotify 事件队列溢出后旧的 token 失效，status 退回到完整扫描
+status 每次运行都会导入本模块，ctypes、socket 等只在用到时才导入
+"""
+import os
+import struct
+import sys
+import time
+from typing import Set, Tuple
+
+SOCKET_NAME = "fsmonitor.sock"
+
+# inotify 事件类型，见 <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# 事件头部 [wd, mask, cookie, name 长度]，之后是以 NULL 填充的 name
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_supported() -> bool:
+    import socket
+    return sys.platform.startswith('linux') and hasattr(socket, 'AF_UNIX')
+
+
+def _request(git_path: str, request: bytes, timeout: float = 2.0) -> [bytes, None]:
+    """
+    向监控进程发送请求并读取全部回复，监控进程没有运行时返回 None
+    """
+    path = os.path.join(git_path, SOCKET_NAME)
+    if not os.path.exists(path) or not is_supported():
+        return None
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(request + b'\n')
+            chunks = []
+            while True:
+                chunk = sock.recv(1 << 16)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+    except OSError:
+        return None
+
+
+def query(git_path: str, token: str) -> [Tuple[str, Set[str]], None]:
+    """
+    查询 token 之后变动的文件，返回 (新的 token, 相对工作目录的 path 集合)，
+    token 无效时 path 集合为 None，表示需要完整扫描；监控进程没有运行时返回 None
+    """
+    data = _request(git_path, b'query ' + token.encode())
+    if not data:
+        return None
+    new_token, _, body = data.partition(b'\x00')
+    if body == b'/':
+        return new_token.decode(), None
+    return new_token.decode(), {os.fsdecode(path) for path in body.split(b"\x00") if path}
+
+
+def start(work_path: str, git_path: str, timeout: float = 10.0) -> bool:
+    """
+    在后台启动监控进程，等待其开始接受查询，已经在运行时直接返回
+    """
+    assert is_supported(), "文件监控只支持 Linux"
+    if query(git_path, "") is not None:
+        return True
+    import subprocess
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), work_path, git_path],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if query(git_path, "") is not None:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def stop(git_path: str) -> bool:
+    return _request(git_path, b'quit') is not None
+
+
+class Monitor:
+    """
+    监控进程，通过 ctypes 调用 libc 的 inotify 接口监控工作目录中除 .git 以外的所有目录
+    files 为当前工作目录中的全部文件，目录被删除或移走时据此标记其中的文件
+    changes 记录每个文件最后一次变动时的序号
+    """
+
+    def __init__(self, work_path: str, git_path: str):
+        import ctypes
+        import ctypes.util
+        self.work_path = work_path
+        self.git_path = git_path
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.watches = {}
+        self.files = set()
+        self.changes = {}
+        self.seq = 0
+        self.instance = ""
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        重新扫描工作目录，之前的 token 全部失效
+        """
+        self.instance = f"{os.getpid()}.{time.time_ns()}"
+        self.seq = 0
+        self.changes.clear()
+        self.files.clear()
+        self.add_tree('', mark=False)
+
+    def token(self) -> str:
+        return f"{self.instance}:{self.seq}"
+
+    def mark(self, path: str) -> None:
+        self.seq += 1
+        self.changes[path] = self.seq
+
+    def add_tree(self, directory: str, mark: bool = True) -> None:
+        """
+        监控 directory 及其子目录，先添加监控再读取目录，避免漏掉之间创建的文件
+        """
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.work_path, directory)),
+                                             WATCH_MASK)
+            if wd < 0:
+                continue
+            self.watches[wd] = directory
+            try:
+                entries = list(os.scandir(os.path.join(self.work_path, directory)))
+            except OSError:
+                continue
+            for entry in entries:
+                path = f"{directory}/{entry.name}" if directory else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if path != ".git":
+                        stack.append(path)
+                    continue
+                self.files.add(path)
+                if mark:
+                    self.mark(path)
+
+    def remove_tree(self, directory: str) -> None:
+        """
+        目录被删除或移走，标记其中全部文件并取消监控
+        """
+        prefix = directory + '/'
+        for path in [path for path in self.files if path.startswith(prefix)]:
+            self.files.discard(path)
+            self.mark(path)
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self) -> None:
+        """
+        读取并处理全部待处理的 inotify 事件
+        """
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\x00')
+                offset += EVENT_HEADER.size + length
+                self.handle(wd, mask, os.fsdecode(name))
+
+    def handle(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            self.reset()
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if not name:
+            return
+        path = f"{directory}/{name}" if directory else name
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove_tree(path)
+            return
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self.files.add(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.files.discard(path)
+        self.mark(path)
+
+    def answer(self, token: str) -> bytes:
+        """
+        返回 token 之后变动的文件，token 不是本进程生成的时返回 /
+        """
+        instance, _, seq = token.rpartition(':')
+        if instance != self.instance or not seq.isdigit() or int(seq) > self.seq:
+            return self.token().encode() + b'\x00/'
+        since = int(seq)
+        paths = [path for path, path_seq in self.changes.items() if path_seq > since]
+        return self.token().encode() + b'\x00' + b'\x00'.join(os.fsencode(path) for path in paths)
+
+    def serve(self) -> None:
+        import select
+        import socket
+        path = os.path.join(self.git_path, SOCKET_NAME)
+        if os.path.exists(path):
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        try:
+            while True:
+                readable, _, _ = select.select([self.fd, server], [], [])
+                if self.fd in readable:
+                    self.read_events()
+                if server not in readable:
+                    continue
+                conn, _ = server.accept()
+                with conn:
+                    conn.settimeout(2)
+                    try:
+                        request = conn.makefile('rb').readline().strip()
+                        # 回复之前先处理已经产生的事件，保证查询之前的修改都包含在回复中
+                        self.read_events()
+                        if request == b'quit':
+                            conn.sendall(b'ok')
+                            return
+                        conn.sendall(self.answer(request[6:].decode()))
+                    except OSError:
+                        continue
+        finally:
+            server.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    Monitor(sys.argv[1], sys.argv[2]).serve()
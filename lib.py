@@ -1,12 +1,38 @@
-import hashlib
+import base64
+import collections
+import contextlib
+import io
 import os
-import struct
-from urllib import request
+import sys
+from typing import TYPE_CHECKING, Iterable, Optional, Set, Tuple, Union
+
+import tracing
+
+if TYPE_CHECKING:
+    from http import client
 
 GIT_SUFFIX = "/info/refs?service=git-receive-pack"
 G_GITHUB_REPO = "https://github.com/zhouzhaoxin/g.git"
 USERNAME = "###"
 PASSWORD = "###"
+# 并行计算 sha1 的线程数，可通过环境变量 G_HASH_WORKERS 配置，默认为 cpu 核数
+HASH_WORKERS = int(os.environ.get("G_HASH_WORKERS", 0)) or os.cpu_count() or 1
+# 流式读写大文件时每次处理的分块大小
+CHUNK_SIZE = 1 << 16
+# 解压对象的 LRU 缓存上限 (字节)，可通过环境变量 G_OBJECT_CACHE_BYTES 配置
+OBJECT_CACHE_BYTES = int(os.environ.get("G_OBJECT_CACHE_BYTES", 0)) or 64 << 20
+# 索引个数达到 SPLIT_INDEX_ENTRIES 时使用 split index，为 0 时不使用
+SPLIT_INDEX_ENTRIES = int(os.environ.get("G_SPLIT_INDEX_ENTRIES", 10000))
+# split index 的变动超过共享 index 的 SPLIT_INDEX_PERCENT% 时合并为新的共享 index
+SPLIT_INDEX_PERCENT = int(os.environ.get("G_SPLIT_INDEX_PERCENT", 20))
+# add 的新文件个数达到 BULK_CHECKIN_FILES 时写入一个 pack 而不是松散对象，为 0 时不使用
+BULK_CHECKIN_FILES = int(os.environ.get("G_BULK_CHECKIN_FILES", 64))
+# 超过该大小 (字节) 的文件仍流式写为松散对象，不在内存中压缩
+BULK_CHECKIN_MAX_SIZE = int(os.environ.get("G_BULK_CHECKIN_MAX_SIZE", 0)) or 8 << 20
+# 超过该大小 (字节) 的对象打包时不计算 delta，也不作为其它对象的 base，相当于 git 的 core.bigFileThreshold
+BIG_FILE_THRESHOLD = int(os.environ.get("G_BIG_FILE_THRESHOLD", 0)) or 16 << 20
+# 打包时 delta 窗口中对象的总大小上限 (字节)，相当于 git 的 pack.windowMemory
+DELTA_WINDOW_MEMORY = int(os.environ.get("G_DELTA_WINDOW_MEMORY", 0)) or 128 << 20
 
 
 def read_file(path: str) -> bytes:
@@ -21,6 +47,73 @@ def write_file(path: str, data: bytes) -> None:
         f.write(data)
 
 
+@contextlib.contextmanager
+def lock_file(path: str):
+    """
+    和 git 一样用 O_CREAT|O_EXCL 创建 path.lock 作为锁，已存在时说明有其它进程正在修改 path，抛出 FileExistsError
+    在 with 中向返回的文件写入新内容，正常结束时将 .lock 重命名为 path，出错时删除 .lock
+    """
+    lock_path = path + ".lock"
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise FileExistsError(f"{lock_path} 已存在，可能有其它 git 进程正在运行，确认没有后删除该文件") from None
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(lock_path, path)
+    except BaseException:
+        os.remove(lock_path)
+        raise
+
+
+@contextlib.contextmanager
+def temp_file(directory: str, prefix: str = "tmp_"):
+    """
+    在 directory 中用 mkstemp 创建临时文件，用于写完才知道文件名的对象和 pack
+    在 with 中向返回的文件写入内容，并把最终路径赋给 f.target；正常结束时将临时文件改为新建文件的权限并重命名为 f.target，
+    f.target 为 None 或出错时删除临时文件
+    """
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(prefix=prefix, dir=directory)
+    try:
+        with os.fdopen(fd, "w+b") as f:
+            f.target = None
+            yield f
+        if f.target is None:
+            os.remove(tmp_path)
+        else:
+            os.chmod(tmp_path, new_file_mode())
+            os.replace(tmp_path, f.target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+_new_file_mode = None
+
+
+def new_file_mode() -> int:
+    """
+    新建文件的权限，和 open 创建的文件一样为 0666 去掉 umask；mkstemp 创建的临时文件为 0600，重命名前改为该权限
+    第一次重命名临时文件时才读取 umask，优先从 /proc/self/status 读取，不支持时才临时修改 umask
+    """
+    global _new_file_mode
+    if _new_file_mode is None:
+        umask = None
+        try:
+            with open("/proc/self/status") as f:
+                umask = next((int(line.split()[1], 8) for line in f if line.startswith("Umask:")), None)
+        except OSError:
+            pass
+        if umask is None:
+            umask = os.umask(0o022)
+            os.umask(umask)
+        _new_file_mode = 0o666 & ~umask
+    return _new_file_mode
+
+
 def find_path(top: str = ".", dirname=".git") -> str:
     """
     递归寻找git工作目录，若没找到则抛出异常
@@ -37,17 +130,254 @@ def find_path(top: str = ".", dirname=".git") -> str:
     return find_path(parent)
 
 
-# noinspection PyUnresolvedReferences,PyTypeChecker,SpellCheckingInspection
-def http_request(url: str, username: str, password: str, data: dict = None) -> bytes:
+class HttpTransport:
+    """
+    复用 TCP/TLS 连接的 HTTP 客户端，ref 查询和 pack 上传共用同一个对象
+    按 (协议, 主机) 缓存空闲的 HTTP/1.1 keep-alive 连接，每次请求预先带上 Basic 认证头，省去 401 的往返
+    重定向到其它 (协议, 主机) 时不再发送认证头，使用新的连接且用完即关闭，拒绝从 https 重定向到 http
+    request:
+        发送请求并返回响应内容，data 为空时发送 get 请求，否则发送 post 请求
+    open:
+        发送请求并返回还没有读取的响应，用于 PktLineReader 边接收边解析
+    close:
+        关闭所有缓存的连接
+    http.client 会引入 email、ssl 等模块，只在发送请求时导入，不影响其它命令的启动时间
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, username: str, password: str, timeout: float = 60):
+        token = base64.b64encode(f"{username}:{password}".encode()).decode()
+        self.headers = {"Authorization": f"Basic {token}"}
+        self.timeout = timeout
+        self._idle = collections.defaultdict(list)
+
+    def _connect(self, scheme: str, netloc: str) -> "client.HTTPConnection":
+        from http import client
+        if scheme == "https":
+            return client.HTTPSConnection(netloc, timeout=self.timeout)
+        return client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def request(self, url: str, data: Union[bytes, Iterable[bytes]] = None) -> bytes:
+        """
+        data 为生成 bytes 的可迭代对象时，以 chunked 编码边生成边上传
+        """
+        with self.open(url, data) as response:
+            body = response.read()
+        tracing.count("http.bytes_received", len(body))
+        return body
+
+    @contextlib.contextmanager
+    def open(self, url: str, data: Union[bytes, Iterable[bytes]] = None, headers: dict = None):
+        """
+        在 with 中按需读取响应，响应读取完后连接放回空闲连接，没有读完时关闭连接
+        headers 为本次请求附加的请求头
+        """
+        from urllib import error, parse
+        origin = parse.urlsplit(url)[:2]
+        cross_origin = False
+        for _ in range(self.MAX_REDIRECTS):
+            key, conn, response = self._send(url, data, headers, cross_origin)
+            try:
+                if response.status in (301, 302, 303, 307, 308) and data is not None:
+                    # 请求内容已经发送 (流式上传时已被消耗)，不能重发到新的地址，不能把重定向当作成功的响应
+                    reason = f"POST 请求被重定向到 {response.getheader('Location')}"
+                    raise error.HTTPError(url, response.status, reason, response.headers, None)
+                if response.status in (301, 302, 303, 307, 308):
+                    location = parse.urljoin(url, response.getheader("Location"))
+                    if parse.urlsplit(url).scheme == "https" and parse.urlsplit(location).scheme != "https":
+                        raise error.URLError(f"拒绝从 https 重定向到 {location}")
+                    # 一旦离开原来的 (协议, 主机)，之后的请求都不再带认证头
+                    cross_origin = cross_origin or parse.urlsplit(location)[:2] != origin
+                    url = location
+                    response.read()
+                    continue
+                if response.status >= 400:
+                    raise error.HTTPError(url, response.status, response.reason, response.headers, None)
+                yield response
+                return
+            finally:
+                if key != origin or response.will_close or not response.isclosed():
+                    conn.close()
+                else:
+                    self._idle[key].append(conn)
+        raise error.URLError(f"重定向次数过多 {url}")
+
+    def _send(self, url: str, data, extra_headers: dict = None, cross_origin: bool = False) \
+            -> Tuple[Tuple[str, str], "client.HTTPConnection", "client.HTTPResponse"]:
+        """
+        cross_origin 为 True 时是重定向到其它主机的请求，不带认证头，也不使用缓存的连接
+        流式上传的请求内容不能重发，空闲连接可能已被服务端的 keep-alive 超时关闭，因此总是使用新的连接
+        """
+        from http import client
+        from urllib import parse
+        parts = parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = dict(self.headers, **(extra_headers or {}))
+        if cross_origin:
+            headers.pop("Authorization", None)
+        streaming = data is not None and not isinstance(data, bytes)
+        if streaming:
+            headers["Transfer-Encoding"] = "chunked"
+        while True:
+            reused = not cross_origin and not streaming and bool(self._idle[key])
+            conn = self._idle[key].pop() if reused else self._connect(*key)
+            try:
+                conn.request("GET" if data is None else "POST", path, body=data, headers=headers,
+                             encode_chunked=streaming)
+                response = conn.getresponse()
+            except (client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # 空闲连接可能已被服务端关闭，换一个新连接重试
+                if reused:
+                    continue
+                raise
+            tracing.count("http.round_trips")
+            tracing.count("http.connections_reused" if reused else "http.connections_opened")
+            return key, conn, response
+
+    def close(self) -> None:
+        for connections in self._idle.values():
+            for conn in connections:
+                conn.close()
+        self._idle.clear()
+
+
+_TRANSPORTS = {}
+
+
+def get_transport(username: str, password: str) -> HttpTransport:
+    """
+    获取同一用户名密码共用的 HttpTransport
+    """
+    key = (username, password)
+    if key not in _TRANSPORTS:
+        _TRANSPORTS[key] = HttpTransport(username, password)
+    return _TRANSPORTS[key]
+
+
+def http_request(url: str, username: str, password: str, data: Union[bytes, Iterable[bytes]] = None) -> bytes:
     """
     使用用户名密码访问网站，默认发送get请求如果 data 不为空则发送 post 请求
+    同一用户名密码的请求共用 HttpTransport 中的连接
     """
-    password_manager = request.HTTPPasswordMgrWithDefaultRealm()
-    password_manager.add_password(None, url, username, password)
-    auth_handler = request.HTTPBasicAuthHandler(password_manager)
-    opener = request.build_opener(auth_handler)
-    f = opener.open(url, data=data)
-    return f.read()
+    return get_transport(username, password).request(url, data)
+
+
+class PktLineReader:
+    """
+    从 file-like 对象中逐行读取 git 的 pkt-line，每行的前 4 位是用 16 进制表示的长度 (包括这 4 位)，0000 为 flush-pkt
+    数据通过 readinto 读入可复用的缓冲区，返回的内容是缓冲区的 memoryview，不复制数据，
+    只在读取下一行之前有效，需要保留时用 bytes() 复制；内存占用只和单行的最大长度有关
+    read_pkt:
+        读取一行，flush-pkt 返回 None，数据结束时抛出 EOFError
+    __iter__:
+        逐行读取直到 flush-pkt 或数据结束
+    iter_sideband:
+        按 side-band-64k 拆分数据，返回通道 1 的数据，通道 2 的进度信息交给 progress，通道 3 的错误信息抛出异常
+    """
+
+    # pkt-line 的最大长度，包括 4 位的长度
+    MAX_LENGTH = 65520
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = bytearray(max(CHUNK_SIZE, self.MAX_LENGTH))
+        self.view = memoryview(self.buffer)
+        self.start = self.end = 0
+
+    def _fill(self, size: int) -> bool:
+        """
+        保证缓冲区中至少有 size 个未读取的字节，数据提前结束时返回 False
+        """
+        if self.end - self.start >= size:
+            return True
+        if self.start + size > len(self.buffer):
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start, self.end = 0, remaining
+        while self.end - self.start < size:
+            count = self.stream.readinto(self.view[self.end:])
+            if not count:
+                return False
+            tracing.count("pkt.bytes", count)
+            self.end += count
+        return True
+
+    def read_pkt(self) -> [memoryview, None]:
+        if not self._fill(4):
+            if self.start == self.end:
+                raise EOFError("pkt-line 数据已结束")
+            raise ValueError("pkt-line 长度不完整")
+        length = int(self.buffer[self.start:self.start + 4], 16)
+        self.start += 4
+        # 0000 为 flush-pkt，0001 和 0002 为 protocol v2 的分隔符，都不带数据
+        if length < 4:
+            return None
+        assert length <= self.MAX_LENGTH, f"pkt-line 长度不合法 {length}"
+        if not self._fill(length - 4):
+            raise ValueError("pkt-line 数据不完整")
+        payload = self.view[self.start:self.start + length - 4]
+        self.start += length - 4
+        tracing.count("pkt.lines")
+        return payload
+
+    def __iter__(self):
+        while True:
+            try:
+                payload = self.read_pkt()
+            except EOFError:
+                return
+            if payload is None:
+                return
+            yield payload
+
+    def iter_sideband(self, progress=None):
+        for payload in self:
+            band, data = payload[0], payload[1:]
+            if band == 1:
+                yield data
+            elif band == 2:
+                (progress or write_progress)(bytes(data))
+            elif band == 3:
+                raise RuntimeError(f"远程错误: {bytes(data).decode(errors='replace').strip()}")
+            else:
+                raise ValueError(f"side-band 通道不合法 {band}")
+
+
+class SidebandReader(io.RawIOBase):
+    """
+    将 side-band-64k 通道 1 中的数据作为 file-like 对象读取，
+    receive-pack 的 report-status 在通道 1 中也是 pkt-line，可以再交给 PktLineReader 解析
+    """
+
+    def __init__(self, reader: PktLineReader, progress=None):
+        super().__init__()
+        self.bands = reader.iter_sideband(progress)
+        self.pending = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            data = next(self.bands, None)
+            if data is None:
+                return 0
+            self.pending = data
+        count = min(len(buffer), len(self.pending))
+        buffer[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+        return count
+
+
+def write_progress(message: bytes) -> None:
+    """
+    输出服务端通过 side-band 通道 2 发送的进度信息
+    """
+    sys.stderr.write("remote: " + message.decode(errors="replace"))
+    sys.stderr.flush()
 
 
 def extract_lines(data: bytes):
@@ -74,21 +404,16 @@ def extract_lines(data: bytes):
     >>> data = http_request(url, username=USERNAME, password=PASSWORD)
     >>> lines = extract_lines(data)
     >>> lines
+    flush-pkt 返回为 b''，不限制行数；远程请求使用 PktLineReader 边接收边解析，不需要完整的响应
     """
+    reader = PktLineReader(io.BytesIO(data))
     lines = []
-    i = 0
-    for _ in range(1000):
-        line_length = int(data[i:i + 4], 16)
-        line = data[i + 4:i + line_length]
-        lines.append(line)
-        # 读取到段尾标记位
-        if line_length == 0:
-            i += 4
-        else:
-            i += line_length
-        if i >= len(data):
-            break
-    return lines
+    while True:
+        try:
+            payload = reader.read_pkt()
+        except EOFError:
+            return lines
+        lines.append(b'' if payload is None else bytes(payload))
 
 
 def build_lines_data(lines):
@@ -108,24 +433,28 @@ def get_remote_master_hash(git_url, username, password) -> [str, None]:
     """
     获取远程 master 结点的 hash,如果没有就返回 None
     """
-    url = git_url + GIT_SUFFIX
-    response = http_request(url, username, password)
-    lines = extract_lines(response)
-    assert lines[0] == b'# service=git-receive-pack\n'
-    assert lines[1] == b''
-    if lines[2][:40] == b'0' * 40:
-        return None
-    master_sha1, master_ref = lines[2].split(b'\x00')[0].split()
-    assert master_ref == b'refs/heads/master'
-    assert len(master_sha1) == 40
-    return master_sha1.decode()
+    return get_remote_info(git_url, username, password)[0]
 
 
-def build_lines_data(lines):
-    result = []
-    for line in lines:
-        result.append('{:04x}'.format(len(line) + 5).encode())
-        result.append(line)
-        result.append(b'\n')
-    result.append(b'0000')
-    return b''.join(result)
+def get_remote_info(git_url, username, password) -> Tuple[Optional[str], Set[bytes]]:
+    """
+    获取远程 master 结点的 hash 和服务端支持的 capabilities，没有 master 时 hash 为 None
+    capabilities 跟在第一个 ref 之后，以 NULL 分隔
+    ref 逐行接收和解析，只保留 master，内存占用和远程 ref 的个数无关
+    """
+    url = git_url + GIT_SUFFIX
+    master_sha1, capabilities = None, set()
+    with get_transport(username, password).open(url) as response:
+        reader = PktLineReader(response)
+        assert reader.read_pkt() == b'# service=git-receive-pack\n'
+        assert reader.read_pkt() is None
+        for i, line in enumerate(reader):
+            line = bytes(line).rstrip(b'\n')
+            if i == 0:
+                line, _, caps = line.partition(b'\x00')
+                capabilities = set(caps.split())
+            sha1, _, ref = line.partition(b' ')
+            if ref == b'refs/heads/master':
+                assert len(sha1) == 40
+                master_sha1 = sha1.decode()
+    return master_sha1, capabilities
@@ -1,43 +1,96 @@
 import click
-import api
+import tracing
+
+
+def call(name: str, *args):
+    """
+    执行 api 中的命令，api 在这里才导入，g --help 和参数错误时不需要加载 base、lib 等模块
+    .lock 文件已存在等 FileExistsError 作为命令错误输出，不打印调用栈
+    """
+    import api
+    try:
+        return getattr(api, name)(*args)
+    except FileExistsError as e:
+        raise click.ClickException(str(e))
 
 
 @click.group()
-def cli():
-    pass
+@click.option("--trace", is_flag=True, help="退出时将各阶段耗时和计数输出到标准错误")
+@click.option("--trace-file", type=click.Path(dir_okay=False), help="退出时将追踪数据以 Chrome trace 格式写入文件")
+def cli(trace, trace_file):
+    if trace_file:
+        tracing.enable(trace_file)
+    elif trace:
+        tracing.enable()
 
 
 @click.command(help="初始化 .git 工作目录")
 def init():
-    api.init()
+    call("init")
 
 
-@click.command(help="添加 git 文件, 目前只支持单个文件")
-@click.argument("path")
-def add(path):
-    api.add([path])
+@click.command(help="添加 git 文件, 支持文件、目录和 glob")
+@click.argument("paths", nargs=-1)
+@click.option("--pathspec-from-file", type=click.File("r"), help="从文件中读取路径，每行一个，- 为标准输入")
+@click.option("-f", "--force", is_flag=True, help="添加被忽略的文件")
+@click.option("-j", "--jobs", default=0, help="并行计算 sha1 的线程数，默认为 cpu 核数")
+def add(paths, pathspec_from_file, force, jobs):
+    paths = list(paths)
+    if pathspec_from_file:
+        paths.extend(line.rstrip('\n') for line in pathspec_from_file if line.strip())
+    if not paths:
+        raise click.UsageError("没有指定需要添加的路径")
+    call("add", paths, jobs, force)
 
 
 @click.command(help="提交")
 @click.argument("message")
 @click.argument("auth")
 def commit(message, auth):
-    api.commit(message, auth)
+    call("commit", message, auth)
 
 
 @click.command(help="提交")
 def push():
-    api.push()
+    call("push")
 
 
 @click.command(help="获取当前工作 git 状态")
-def status():
-    api.status()
+@click.option("-j", "--jobs", default=0, help="并行计算 sha1 的线程数，默认为 cpu 核数")
+def status(jobs):
+    call("status", jobs)
 
 
 @click.command(help="查询 git 改变")
-def diff():
-    api.diff()
+@click.option("-j", "--jobs", default=0, help="并行计算 sha1 的线程数，默认为 cpu 核数")
+@click.option("-U", "--unified", default=3, help="diff 的上下文行数")
+def diff(jobs, unified):
+    call("diff", jobs, unified)
+
+
+@click.command(help="显示提交历史")
+@click.option("-n", "--max-count", default=0, help="最多显示的提交个数")
+@click.option("--oneline", is_flag=True, help="每个提交只显示一行")
+def log(max_count, oneline):
+    call("log", max_count, oneline)
+
+
+@click.command(name="commit-graph", help="重新生成 commit-graph 文件")
+def commit_graph():
+    call("commit_graph")
+
+
+@click.command(help="打包对象并清理松散对象")
+@click.option("--window", default=10, help="查找 delta base 的窗口大小")
+@click.option("--depth", default=50, help="delta 链的最大长度")
+def gc(window, depth):
+    call("gc", window, depth)
+
+
+@click.command(help="启动或停止工作目录的文件监控进程 (仅支持 Linux)")
+@click.argument("action", type=click.Choice(["start", "stop"]))
+def fsmonitor(action):
+    call("fsmonitor", action)
 
 
 cli.add_command(init)
@@ -46,3 +99,7 @@ cli.add_command(commit)
 cli.add_command(status)
 cli.add_command(diff)
 cli.add_command(push)
+cli.add_command(gc)
+cli.add_command(log)
+cli.add_command(commit_graph)
+cli.add_command(fsmonitor)
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """
+    在临时目录中初始化的 git 工作目录，返回 .git 的路径
+    """
+    import api
+    monkeypatch.chdir(tmp_path)
+    api.init()
+    return str(tmp_path / ".git")
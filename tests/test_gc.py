@@ -0,0 +1,27 @@
+import os
+import shutil
+
+import api
+import base
+
+
+def test_gc_reads_packed_commits_with_tiny_cache(repo, monkeypatch):
+    """
+    gc 删除松散对象后，没有 commit-graph 且缓存放不下对象时也要从新的 pack 中读取 commit
+    """
+    monkeypatch.setattr(base.HashObject, "cache", base.ObjectCache(1))
+    for i in range(3):
+        with open(f"f{i}", "w") as f:
+            f.write(f"content {i}\n")
+        api.add([f"f{i}"])
+        api.commit(f"commit {i}", "a <a@example.com>")
+    shutil.rmtree(os.path.join(repo, "objects", "info"))
+
+    api.gc()
+
+    commit_obj = base.Commit(repo)
+    head = commit_obj.get_local_master_hash()
+    assert commit_obj.graph.find(head) is not None
+    assert len(list(commit_obj.iter_history(head))) == 3
+    pack_dir = os.path.join(repo, "objects", "pack")
+    assert any(name.endswith(".bitmap") for name in os.listdir(pack_dir))
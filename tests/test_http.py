@@ -0,0 +1,72 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import error
+
+import pytest
+
+from lib import HttpTransport
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    keep-alive 连接空闲 0.2 秒后由服务端关闭，/redirect 返回 307
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = 0.2
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: bytes) -> None:
+        if self.path == "/redirect":
+            self.send_response(307)
+            self.send_header("Location", "/other")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(b"refs")
+
+    def do_POST(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if size == 0:
+                break
+        self._reply(b"received " + b"".join(chunks))
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_streamed_post_after_idle_timeout(server):
+    """
+    ref 查询后的空闲连接被服务端关闭，流式上传不能复用它
+    """
+    transport = HttpTransport("user", "password")
+    assert transport.request(server + "/info/refs") == b"refs"
+    time.sleep(0.5)
+    assert transport.request(server + "/receive-pack", iter([b"pack", b"data"])) == b"received packdata"
+    transport.close()
+
+
+def test_redirected_post_is_an_error(server):
+    transport = HttpTransport("user", "password")
+    with pytest.raises(error.HTTPError):
+        transport.request(server + "/redirect", iter([b"pack"]))
+    transport.close()
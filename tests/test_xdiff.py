@@ -0,0 +1,56 @@
+import random
+import time
+
+import xdiff
+
+
+def apply_diff(old: bytes, new: bytes) -> bytes:
+    """
+    用 diff_lines 的匹配把 old 改写为 new，检查匹配是否有序且内容一致
+    """
+    old_lines, new_lines = xdiff.split_lines(old), xdiff.split_lines(new)
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in old_lines]
+    b = [ids.setdefault(line, len(ids)) for line in new_lines]
+    result, i, j = [], 0, 0
+    for match_a, match_b, size in xdiff.diff_lines(a, b):
+        assert match_a >= i and match_b >= j
+        assert old_lines[match_a:match_a + size] == new_lines[match_b:match_b + size]
+        result.extend(new_lines[j:match_b])
+        result.extend(old_lines[match_a:match_a + size])
+        i, j = match_a + size, match_b + size
+    result.extend(new_lines[j:])
+    return b''.join(result)
+
+
+def test_random_edits():
+    rng = random.Random(0)
+    for _ in range(200):
+        old = [rng.choice("abcdefg") + "\n" for _ in range(rng.randint(0, 60))]
+        new = list(old)
+        for _ in range(rng.randint(0, 10)):
+            pos = rng.randint(0, len(new))
+            if rng.random() < 0.4 and new:
+                del new[min(pos, len(new) - 1)]
+            else:
+                new.insert(pos, rng.choice("abcdefghij") + "\n")
+        old_data, new_data = "".join(old).encode(), "".join(new).encode()
+        assert apply_diff(old_data, new_data) == new_data
+
+
+def _repeated_lines_time(n: int) -> float:
+    old = b"".join(b"line %d\n" % i for i in range(n))
+    new = b"".join(b"line %d\n" % i * 7 for i in range(n))
+    start = time.perf_counter()
+    assert apply_diff(old, new) == new
+    return time.perf_counter() - start
+
+
+def test_scaling_is_not_quadratic():
+    """
+    每行重复 7 次的修改曾经让锚点查找退化为 O(n^2)，行数增加 8 倍时耗时应远小于 64 倍
+    """
+    small = _repeated_lines_time(5000)
+    large = _repeated_lines_time(40000)
+    assert large < 5
+    assert large < small * 24
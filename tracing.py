@@ -0,0 +1,160 @@
+"""
+命令的性能追踪，记录各阶段的耗时和热点路径上的计数
+    通过 g --trace / --trace-file 或环境变量 G_TRACE 开启：
+        G_TRACE=1                 退出时将汇总输出到标准错误
+        G_TRACE=/tmp/trace.json   退出时写入 Chrome trace event 格式的 JSON，可在 chrome://tracing 中查看
+    未开启时 Span/count 只检查一次 ENABLED，几乎没有开销
+    命名为 tracing 以避免和标准库的 trace 模块冲突
+"""
+import atexit
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+
+ENABLED = False
+# 输出 Chrome trace 的文件，为空时输出汇总
+OUTPUT = ""
+
+counters = collections.Counter()
+# (阶段名称, 开始时间, 耗时, 线程)，时间单位为纳秒
+events = []
+_lock = threading.Lock()
+_start = 0
+# 开启追踪的进程，diff 等命令的子进程继承了模块状态但不输出
+_pid = None
+
+
+def enable(output: str = "") -> None:
+    """
+    开启追踪，output 为 "1"、"summary" 或空时输出汇总，否则为 Chrome trace 的文件路径
+    """
+    global ENABLED, OUTPUT, _start, _pid
+    if ENABLED:
+        return
+    ENABLED = True
+    OUTPUT = "" if output in ("", "1", "summary") else output
+    _start = time.perf_counter_ns()
+    _pid = os.getpid()
+    atexit.register(report)
+
+
+def count(name: str, n: int = 1) -> None:
+    if ENABLED:
+        with _lock:
+            counters[name] += n
+
+
+def init_worker(enabled: bool) -> None:
+    """
+    进程池的 initializer，子进程只记录计数，由 take_counters 随任务结果带回开启追踪的进程
+    清空 fork 时从父进程继承的计数和阶段，避免合并时重复计算
+    """
+    global ENABLED
+    ENABLED = enabled
+    counters.clear()
+    events.clear()
+
+
+def take_counters() -> dict:
+    """
+    返回并清空当前进程的计数
+    """
+    with _lock:
+        taken = dict(counters)
+        counters.clear()
+    return taken
+
+
+def merge_counters(taken: dict) -> None:
+    """
+    合并子进程中 take_counters 返回的计数
+    """
+    if ENABLED and taken:
+        with _lock:
+            counters.update(taken)
+
+
+class Span:
+    """
+    记录一个阶段的耗时
+        with tracing.Span("status.scan"):
+            ...
+    """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if ENABLED:
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            end = time.perf_counter_ns()
+            events.append((self.name, self.start, end - self.start, threading.get_ident()))
+
+
+def traced(name: str):
+    """
+    记录函数耗时的装饰器
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary() -> str:
+    totals = collections.OrderedDict()
+    for name, _, duration, _ in sorted(events, key=lambda event: event[1]):
+        calls, total = totals.get(name, (0, 0))
+        totals[name] = (calls + 1, total + duration)
+    lines = [f"trace: 总耗时 {(time.perf_counter_ns() - _start) / 1e9:.3f}s",
+             f"  {'阶段':<32}{'次数':>8}{'耗时(s)':>12}"]
+    for name, (calls, total) in totals.items():
+        lines.append(f"  {name:<34}{calls:>8}{total / 1e9:>12.4f}")
+    if counters:
+        lines.append("  计数")
+        for name, value in sorted(counters.items()):
+            lines.append(f"  {name:<34}{value:>20}")
+    return '\n'.join(lines)
+
+
+def chrome_trace() -> dict:
+    """
+    生成 Chrome trace event 格式，阶段为完整事件 (ph=X)，计数器为结束时的计数事件 (ph=C)，时间单位为微秒
+    """
+    pid = os.getpid()
+    trace_events = [{"name": name, "ph": "X", "ts": (start - _start) / 1000, "dur": duration / 1000,
+                     "pid": pid, "tid": tid} for name, start, duration, tid in events]
+    end = (time.perf_counter_ns() - _start) / 1000
+    for name, value in sorted(counters.items()):
+        trace_events.append({"name": name, "ph": "C", "ts": end, "pid": pid, "args": {name: value}})
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+def report() -> None:
+    if os.getpid() != _pid:
+        return
+    if OUTPUT:
+        import json
+        with open(OUTPUT, "w") as f:
+            json.dump(chrome_trace(), f)
+    else:
+        print(summary(), file=sys.stderr)
+
+
+if os.environ.get("G_TRACE"):
+    enable(os.environ["G_TRACE"])
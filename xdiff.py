@@ -0,0 +1,301 @@
+"""
+逐行对比两个文件的内容，生成 unified 格式的 diff
+    每一行先转换为整数编号，之后只比较整数
+    对比使用 git 的 histogram 算法：去掉公共的首尾行后，在旧文件中只出现一次的公共行按 patience diff 的方式
+    一次求出位置递增的最长序列作为锚点；没有这样的行时选取出现次数最少的公共行，从锚点向前后扩展出最长的匹配，
+    再分别处理锚点之间的部分；
+    没有出现次数不超过 MAX_CHAIN 的公共行时使用 Myers 算法，编辑距离超过 MYERS_MAX_COST 时整段作为替换
+    查找锚点时扫描的行数累计超过 WORK_FACTOR * 总行数时，剩下的区间都整段作为替换，总耗时和行数成线性关系
+    输出以生成器的形式逐行返回，不拼接完整的 diff
+"""
+import bisect
+from typing import Iterator, List, Tuple
+
+# histogram 算法中出现次数超过 MAX_CHAIN 的行不作为锚点
+MAX_CHAIN = 64
+MYERS_MAX_COST = 512
+# 查找锚点时扫描行数的预算为 WORK_FACTOR * (新旧文件的总行数) + WORK_MIN
+WORK_FACTOR = 32
+WORK_MIN = 1 << 16
+# 和 git 一样，文件前 8000 个字节中有 NULL 时视为二进制文件
+BINARY_CHECK_SIZE = 8000
+
+
+def is_binary(data: bytes) -> bool:
+    return b'\x00' in data[:BINARY_CHECK_SIZE]
+
+
+def split_lines(data: bytes) -> List[bytes]:
+    """
+    按 \\n 分割并保留行尾，最后一行没有 \\n 时原样保留
+    """
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def diff_lines(a: List[int], b: List[int]) -> List[Tuple[int, int, int]]:
+    """
+    对比两个行编号列表，按顺序返回匹配的部分 [(a 中的位置, b 中的位置, 行数)]
+    """
+    matches = []
+    budget = WORK_FACTOR * (len(a) + len(b)) + WORK_MIN
+    # 栈中为待处理的区间 (a_lo, a_hi, b_lo, b_hi) 或已确定的匹配 (i, j, 行数)，按相反的顺序压入
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3:
+            matches.append(item)
+            continue
+        a_lo, a_hi, b_lo, b_hi = item
+        start_a, start_b = a_lo, b_lo
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        end_a = a_hi
+        while a_hi > a_lo and b_hi > b_lo and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+        if end_a > a_hi:
+            stack.append((a_hi, b_hi, end_a - a_hi))
+        if a_lo < a_hi and b_lo < b_hi:
+            # 超出预算后不再查找锚点，区间整段作为替换
+            budget -= (a_hi - a_lo) + (b_hi - b_lo)
+            if budget >= 0:
+                occurrences = {}
+                for i in range(a_lo, a_hi):
+                    occurrences.setdefault(a[i], []).append(i)
+                anchors = _unique_anchors(occurrences, b, b_lo, b_hi)
+                anchor = () if anchors else _find_anchor(a, b, a_lo, a_hi, b_lo, b_hi, occurrences)
+                if anchors:
+                    stack.extend(reversed(_split_by_anchors(anchors, a_lo, a_hi, b_lo, b_hi)))
+                elif anchor is None:
+                    stack.extend(reversed(_myers(a, b, a_lo, a_hi, b_lo, b_hi)))
+                elif anchor:
+                    i, j, size = anchor
+                    stack.append((i + size, a_hi, j + size, b_hi))
+                    stack.append(anchor)
+                    stack.append((a_lo, i, b_lo, j))
+        if a_lo > start_a:
+            stack.append((start_a, start_b, a_lo - start_a))
+    return matches
+
+
+def _unique_anchors(occurrences: dict, b: List[int], b_lo: int, b_hi: int) -> List[Tuple[int, int]]:
+    """
+    occurrences 为旧文件区间中每一行的位置列表，旧文件中只出现一次的行按在新文件中的顺序排列，
+    求旧文件位置严格递增的最长子序列 (patience diff 的 LIS)，一次得到区间内的全部锚点 [(i, j)]
+    同一行在新文件中出现多次时只使用第一次，耗时 O(m log m)
+    """
+    pairs, prev = [], []
+    # tails[k] 为长度 k + 1 的递增序列中结尾最小的一个在 pairs 中的位置，tail_i 为其结尾的 i
+    tails, tail_i = [], []
+    for j in range(b_lo, b_hi):
+        positions = occurrences.get(b[j])
+        if positions is None or len(positions) != 1:
+            continue
+        i = positions[0]
+        k = bisect.bisect_left(tail_i, i)
+        if k < len(tail_i) and tail_i[k] == i:
+            continue
+        prev.append(tails[k - 1] if k else -1)
+        pairs.append((i, j))
+        if k == len(tails):
+            tails.append(len(pairs) - 1)
+            tail_i.append(i)
+        else:
+            tails[k] = len(pairs) - 1
+            tail_i[k] = i
+    anchors = []
+    k = tails[-1] if tails else -1
+    while k >= 0:
+        anchors.append(pairs[k])
+        k = prev[k]
+    anchors.reverse()
+    return anchors
+
+
+def _split_by_anchors(anchors: List[Tuple[int, int]], a_lo: int, a_hi: int, b_lo: int, b_hi: int) -> list:
+    """
+    按顺序返回锚点之间的区间和锚点的匹配，相邻的锚点合并为一个匹配
+    """
+    items = []
+    i, j = a_lo, b_lo
+    for anchor_i, anchor_j in anchors:
+        if items and len(items[-1]) == 3 and anchor_i == i and anchor_j == j:
+            start_i, start_j, size = items[-1]
+            items[-1] = (start_i, start_j, size + 1)
+        else:
+            items.append((i, anchor_i, j, anchor_j))
+            items.append((anchor_i, anchor_j, 1))
+        i, j = anchor_i + 1, anchor_j + 1
+    items.append((i, a_hi, j, b_hi))
+    return items
+
+
+def _find_anchor(a: List[int], b: List[int], a_lo: int, a_hi: int, b_lo: int, b_hi: int, occurrences: dict):
+    """
+    在区间中查找锚点匹配 (i, j, 行数)，优先选择出现次数最少的行，次数相同时选择最长的匹配
+    occurrences 为旧文件区间中每一行的位置列表
+    没有公共行时返回 ()，公共行出现次数都超过 MAX_CHAIN 时返回 None
+    """
+    best, best_count, best_size = (), MAX_CHAIN, 0
+    common = False
+    j = b_lo
+    while j < b_hi:
+        positions = occurrences.get(b[j])
+        next_j = j + 1
+        if positions is not None:
+            common = True
+            if len(positions) <= best_count:
+                for i in positions:
+                    start_a, start_b, count = i, j, len(positions)
+                    while start_a > a_lo and start_b > b_lo and a[start_a - 1] == b[start_b - 1]:
+                        start_a -= 1
+                        start_b -= 1
+                        count = min(count, len(occurrences[a[start_a]]))
+                    end_a, end_b = i + 1, j + 1
+                    while end_a < a_hi and end_b < b_hi and a[end_a] == b[end_b]:
+                        count = min(count, len(occurrences[a[end_a]]))
+                        end_a += 1
+                        end_b += 1
+                    size = end_a - start_a
+                    if count < best_count or (count == best_count and size > best_size):
+                        best, best_count, best_size = (start_a, start_b, size), count, size
+                    next_j = max(next_j, end_b)
+        j = next_j
+    if not best and common:
+        return None
+    return best
+
+
+def _myers(a: List[int], b: List[int], a_lo: int, a_hi: int, b_lo: int, b_hi: int) -> List[Tuple[int, int, int]]:
+    """
+    Myers 算法求区间的最短编辑路径，返回匹配的部分，编辑距离超过 MYERS_MAX_COST 时返回空列表
+    第 d 步只记录对角线 k = -d, -d + 2, ..., d 上走得最远的 x，保存在长度为 d + 1 的列表中，
+    MYERS_MAX_COST 较小，时间和内存都限制在 O(MYERS_MAX_COST ** 2)
+    """
+    n, m = a_hi - a_lo, b_hi - b_lo
+    trace = []
+    prev = [0]
+    for d in range(min(n + m, MYERS_MAX_COST) + 1):
+        current = [0] * (d + 1)
+        trace.append(current)
+        for i in range(d + 1):
+            k = 2 * i - d
+            # 对角线 k 在上一步的列表中位于 i - 1 (k - 1) 和 i (k + 1)
+            if i == 0 or (i != d and prev[i - 1] < prev[i]):
+                x = prev[i] if d else 0
+            else:
+                x = prev[i - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            current[i] = x
+            if x >= n and y >= m:
+                return _myers_matches(trace, n, m, a_lo, b_lo)
+        prev = current
+    return []
+
+
+def _myers_matches(trace: List[List[int]], x: int, y: int, a_lo: int, b_lo: int) -> List[Tuple[int, int, int]]:
+    matches = []
+    for d in range(len(trace) - 1, -1, -1):
+        k = x - y
+        i = (k + d) // 2
+        if d == 0:
+            prev_x, prev_y, mid_x = 0, 0, 0
+        else:
+            prev = trace[d - 1]
+            if i == 0 or (i != d and prev[i - 1] < prev[i]):
+                prev_x = prev[i]
+                prev_y = prev_x - k - 1
+                mid_x = prev_x
+            else:
+                prev_x = prev[i - 1]
+                prev_y = prev_x - k + 1
+                mid_x = prev_x + 1
+        size = x - mid_x
+        if size > 0:
+            matches.append((a_lo + mid_x, b_lo + y - size, size))
+        x, y = prev_x, prev_y
+    matches.reverse()
+    return matches
+
+
+def _format_range(start: int, stop: int) -> str:
+    """
+    和 diff -u 一样，长度为 1 时只输出起始行号，长度为 0 时起始行号为前一行
+    """
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+def _hunks(matches: List[Tuple[int, int, int]], a_size: int, b_size: int, context: int):
+    """
+    将匹配之间的改动按上下文行数分组，返回 [(a 起始, a 结束, b 起始, b 结束, 改动列表)]
+    """
+    changes = []
+    i = j = 0
+    for match_a, match_b, size in matches + [(a_size, b_size, 0)]:
+        if i < match_a or j < match_b:
+            changes.append((i, match_a, j, match_b))
+        i, j = match_a + size, match_b + size
+    hunks = []
+    for change in changes:
+        if hunks and change[0] - hunks[-1][4][-1][1] <= 2 * context:
+            hunks[-1][4].append(change)
+            continue
+        hunks.append([0, 0, 0, 0, [change]])
+    for hunk in hunks:
+        first, last = hunk[4][0], hunk[4][-1]
+        hunk[0] = max(first[0] - context, 0)
+        hunk[2] = first[2] - (first[0] - hunk[0])
+        hunk[1] = min(last[1] + context, a_size)
+        hunk[3] = last[3] + (hunk[1] - last[1])
+    return hunks
+
+
+def _line(prefix: bytes, line: bytes) -> bytes:
+    if line.endswith(b'\n'):
+        return prefix + line
+    return prefix + line + b'\n\\ No newline at end of file\n'
+
+
+def unified_diff(old: bytes, new: bytes, old_name: str, new_name: str, context: int = 3) -> Iterator[bytes]:
+    """
+    逐行生成 old 到 new 的 unified diff，内容相同时不输出，二进制文件只输出一行提示
+    """
+    if old == new:
+        return
+    if is_binary(old) or is_binary(new):
+        yield f"Binary files {old_name} and {new_name} differ\n".encode()
+        return
+    old_lines, new_lines = split_lines(old), split_lines(new)
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in old_lines]
+    b = [ids.setdefault(line, len(ids)) for line in new_lines]
+    hunks = _hunks(diff_lines(a, b), len(a), len(b), context)
+    yield f"--- {old_name}\n".encode()
+    yield f"+++ {new_name}\n".encode()
+    for a_start, a_end, b_start, b_end, changes in hunks:
+        yield f"@@ -{_format_range(a_start, a_end)} +{_format_range(b_start, b_end)} @@\n".encode()
+        i = a_start
+        for change_a, change_a_end, change_b, change_b_end in changes:
+            for line in old_lines[i:change_a]:
+                yield _line(b' ', line)
+            for line in old_lines[change_a:change_a_end]:
+                yield _line(b'-', line)
+            for line in new_lines[change_b:change_b_end]:
+                yield _line(b'+', line)
+            i = change_a_end
+        for line in old_lines[i:a_end]:
+            yield _line(b' ', line)